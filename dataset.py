@@ -0,0 +1,161 @@
+import os
+import json
+import random
+from glob import glob
+import multiprocessing
+import torch
+from utils import SAMPLE_RATE, load_pcm16, intervals_to_labels, read_tar_samples, create_file_table, file_table_get
+from utils_store import LabelStore, LABEL_SCALE
+
+#
+# Parameters
+#
+
+PARAM_WORKERS = multiprocessing.cpu_count()
+PARAM_PREFETCH = 4 # Batches prepared in advance by each loader worker
+PARAM_TOKEN = 320 # 20ms tokens, same as synthesize_sample
+PARAM_DURATION = 5 # Seconds, same as PARAM_DURATION in synthesize.py
+
+#
+# Datasets
+#
+# All return (audio, labels): float audio and an int label per 20ms token.
+#
+
+def fit_sample(audio, labels, length = PARAM_DURATION * SAMPLE_RATE):
+    # Codecs can change the length a bit, samples are padded or trimmed so that they batch
+    tokens = length // PARAM_TOKEN
+    audio = torch.nn.functional.pad(audio[:length], (0, max(0, length - audio.shape[0])))
+    labels = torch.nn.functional.pad(labels[:tokens], (0, max(0, tokens - labels.shape[0])))
+    return audio, labels
+
+class VADDataset(torch.utils.data.Dataset):
+    # Map-style dataset over a synthesized directory of WAV files
+    def __init__(self, path):
+        self.path = path
+        if os.path.isdir(path + "labels/"):
+            self.labels = LabelStore(path + "labels/")
+            self.meta = None
+            files = self.labels.files()
+        else:
+            self.labels = None
+            with open(path + "meta.json", "r") as f:
+                self.meta = json.load(f)
+            files = sorted(self.meta.keys())
+        self.files = create_file_table(files)
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getitem__(self, index):
+        fname = file_table_get(self.files, index)
+        audio = load_pcm16(self.path + fname)
+        intervals = self.labels.get(index) if self.labels is not None else self.meta[fname]
+        return fit_sample(audio, intervals_to_labels(intervals, audio.shape[0] // PARAM_TOKEN, LABEL_SCALE))
+
+class VADShardDataset(torch.utils.data.IterableDataset):
+    # Iterable dataset over tar shards (PARAM_OUTPUT_FORMAT = "tar"), every
+    # shard is read sequentially by a single loader worker
+    def __init__(self, path, shuffle = False, buffer = 1000, seed = 42, rank = 0, world_size = 1):
+        self.shards = sorted(glob(path + "*.tar"))
+        if len(self.shards) == 0:
+            raise Exception("No shards found in " + path)
+        self.shuffle = shuffle
+        self.buffer = buffer
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def worker_shards(self):
+        # Shards are split between processes (rank) and their loader workers
+        shards = list(self.shards)
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(shards)
+        worker = torch.utils.data.get_worker_info()
+        workers, index = (1, 0) if worker is None else (worker.num_workers, worker.id)
+        return shards[self.rank * workers + index::self.world_size * workers]
+
+    def samples(self):
+        for shard in self.worker_shards():
+            for key, audio, intervals in read_tar_samples(shard):
+                yield fit_sample(audio, intervals_to_labels(intervals, audio.shape[0] // PARAM_TOKEN, LABEL_SCALE))
+
+    def __iter__(self):
+        if not self.shuffle:
+            yield from self.samples()
+            return
+
+        # Shuffle buffer, shards are contiguous ranges of samples
+        worker = torch.utils.data.get_worker_info()
+        rng = random.Random(f'{self.seed}/{self.epoch}/{self.rank}/{0 if worker is None else worker.id}')
+        pending = []
+        for sample in self.samples():
+            if len(pending) < self.buffer:
+                pending.append(sample)
+                continue
+            i = rng.randrange(len(pending))
+            yield pending[i]
+            pending[i] = sample
+        rng.shuffle(pending)
+        yield from pending
+
+class SynthesisDataset(torch.utils.data.IterableDataset):
+    # Renders samples on the fly with the parameters of synthesize.py instead of
+    # reading them from disk. Sample i is the i-th sample synthesize.py would
+    # write for the same split, the stream is endless if count is None
+    def __init__(self, speech_dir, background_dir, rir_real_dir, rir_dir, split = "online", count = None, batch_size = 32, rank = 0, world_size = 1):
+        import synthesize # Only imported when used, ffmpeg codecs and effects need torchaudio with ffmpeg
+        self.sources = {
+            'speech': synthesize.index_sources(speech_dir),
+            'background': synthesize.index_sources(background_dir, windows=True),
+            'rir': synthesize.index_sources(rir_dir),
+            'rir_real': synthesize.index_sources(rir_real_dir)
+        }
+        self.split = split
+        self.count = count
+        self.batch_size = batch_size
+        self.rank = rank
+        self.world_size = world_size
+
+    def __iter__(self):
+        import synthesize
+        counts = { k: len(v) for k, v in self.sources.items() }
+        length = synthesize.PARAM_DURATION * synthesize.SAMPLE_RATE
+
+        # Sample indices are interleaved between processes (rank) and loader workers
+        worker = torch.utils.data.get_worker_info()
+        workers, index = (1, 0) if worker is None else (worker.num_workers, worker.id)
+        first = self.rank * workers + index
+        step = self.world_size * workers
+
+        # Plan and render a batch at a time
+        while self.count is None or first < self.count:
+            indices = [first + i * step for i in range(self.batch_size)]
+            if self.count is not None:
+                indices = [i for i in indices if i < self.count]
+            plan = synthesize.plan_samples(self.split, counts, indices, progress=False)
+            samples, labels = synthesize.render_samples(plan, self.sources, range(len(indices)))
+            for sample, l in zip(samples, labels):
+                yield fit_sample(sample, l.int(), length)
+            first += self.batch_size * step
+
+#
+# Loader
+#
+
+def create_loader(dataset, batch_size, workers = PARAM_WORKERS, shuffle = True, drop_last = None):
+    # Only training loaders (shuffle) drop the last partial batch by default
+    if drop_last is None:
+        drop_last = shuffle
+    iterable = isinstance(dataset, torch.utils.data.IterableDataset)
+    return torch.utils.data.DataLoader(dataset,
+                                       batch_size=batch_size,
+                                       shuffle=shuffle and not iterable, # Iterable datasets shuffle themselves
+                                       num_workers=workers,
+                                       prefetch_factor=PARAM_PREFETCH if workers > 0 else None,
+                                       persistent_workers=workers > 0,
+                                       drop_last=drop_last)
@@ -4,11 +4,14 @@ warnings.filterwarnings("ignore")
 import os
 from tqdm import tqdm
 import torch
-from glob import glob
 import multiprocessing
 import json
-from utils import labels_to_intervals, SAMPLE_RATE, load_audio
-from utils_synth import sound_detector, smooth_sound_detector
+import argparse
+from utils import labels_to_intervals, write_meta_json, SAMPLE_RATE, load_audio, load_audio_blocks, worker_context, init_worker_context, create_file_table, file_table_get
+from utils_synth import smooth_sound_detector, smooth_sound_detector_batch, StreamingSmoother
+from utils_store import write_label_store, LabelStore, ScoreStore, ScoreStoreWriter
+from utils_features import get_mel_filters, get_window, log_mel_spectrogram, log_mel_batch, open_feature_store, build_feature_store
+from utils_index import list_files, audio_info
 import onnxruntime as rt
 import numpy as np
 
@@ -24,19 +27,47 @@ PARAM_SPEECH_NEURAL_TRESHOLD = 0.8 # Detector sensitivity
 PARAM_SPEECH_NEURAL_ENGINE = "onnx" # "torch" or "onnx"
 PARAM_SPEECH_SMOOTH = 8 # Detector smoothing (number of 20ms tokens without voice that could be ignored)
 PARAM_WORKERS = multiprocessing.cpu_count()
+PARAM_FILES_PER_TASK = 16 # Files sent to a worker at once, their windows are evaluated together
+PARAM_ONNX_BATCH = 2048 # Windows per ONNX call
+PARAM_TORCH_BATCH = 512 # Windows per torch model call
+PARAM_FEATURE_STORE = False # Keep log-mel features of ONNX mode in <dir>.features/ and reuse them on next runs
+PARAM_STREAM_MIN_DURATION = 60 # Files longer than this (in seconds) are read and detected block by block
+PARAM_STREAM_BLOCK = SAMPLE_RATE * 10 # Samples read at once when streaming
+PARAM_SWEEP_NAIVE_TRESHOLDS = [0.005, 0.01, 0.02, 0.05] # Tresholds tried by --sweep in naive mode
+PARAM_SWEEP_NEURAL_TRESHOLDS = [0.5, 0.6, 0.7, 0.8, 0.9] # Tresholds tried by --sweep in neural mode
+PARAM_SWEEP_SMOOTH = [0, 4, 8, 16] # Smoothing tried by --sweep
+PARAM_SWEEP_BATCH = 256 # Files evaluated together by --sweep
+PARAM_META_JSON = True # Also write legacy meta.json next to the label store
 
 #
 # Loading neural model
 #
 
-mel_filters = torch.from_numpy(np.load("./mel_filters.npz", allow_pickle=False)["mel_80"])
-if PARAM_MODE == "neural":
-    if PARAM_SPEECH_NEURAL_ENGINE == "torch":
+PADDING = 3200 - 320 # Zeros before the audio, so that the first window ends at the first token
+
+# Models are loaded lazily in the process that uses them: a session created
+# before forking shares its thread pools with every worker
+model = None
+onnx_session = None
+
+def get_model():
+    global model
+    if model is None:
         model = torch.jit.load("./detect.pt")
         model.eval()
         # model.to("mps")
-    elif PARAM_SPEECH_NEURAL_ENGINE == "onnx":
-        onnx_session = rt.InferenceSession("detect.onnx")
+    return model
+
+def get_onnx_session():
+    global onnx_session
+    if onnx_session is None:
+        # Workers split the cores instead of each one using all of them
+        options = rt.SessionOptions()
+        options.intra_op_num_threads = max(1, multiprocessing.cpu_count() // max(1, PARAM_WORKERS))
+        options.inter_op_num_threads = 1
+        options.execution_mode = rt.ExecutionMode.ORT_SEQUENTIAL
+        onnx_session = rt.InferenceSession("detect.onnx", sess_options=options)
+    return onnx_session
 
 #
 # Detector
@@ -63,91 +94,249 @@ def sliding_window(tensor, window_size, step):
 
     return unfolded
 
-def detect_iter(dir, files, index):
-    audio = load_audio(dir + files[index])
-    duration = audio.shape[0] / SAMPLE_RATE
+def onnx_windows(log_spec):
+    # Windows of 20 frames with step 2 as [W, 80, 20], a view without copies
+    if log_spec.shape[1] < 21: # Shorter than a window
+        return torch.zeros(0, 80, 20)
+    return log_spec[:, :-1].unfold(-1, 20, 2).permute(1, 0, 2)
+
+def run_onnx(windows):
+    # Windows of all files are copied into fixed size micro-batches, so that a
+    # call covers several short files or a part of a long one
+    session = get_onnx_session()
+    counts = [w.shape[0] for w in windows]
+    predictions = np.zeros(sum(counts), dtype=np.float32)
+    buffer = np.empty((PARAM_ONNX_BATCH, 80, 20), dtype=np.float32)
+    filled = 0
+    done = 0
+    for w in windows:
+        offset = 0
+        while offset < w.shape[0]:
+            n = min(PARAM_ONNX_BATCH - filled, w.shape[0] - offset)
+            buffer[filled:filled + n] = w[offset:offset + n].numpy()
+            filled += n
+            offset += n
+            if filled == PARAM_ONNX_BATCH:
+                predictions[done:done + filled] = session.run(["output"], { 'input': buffer })[0].reshape(-1)
+                done += filled
+                filled = 0
+    if filled > 0:
+        predictions[done:done + filled] = session.run(["output"], { 'input': buffer[:filled] })[0].reshape(-1)
 
+    # Split back by file
+    return [torch.from_numpy(p) for p in np.split(predictions, np.cumsum(counts)[:-1])]
+
+def run_torch(windows):
+    model = get_model()
+    with torch.inference_mode():
+        return torch.cat([model(windows[i:i + PARAM_TORCH_BATCH])[:, 0] for i in range(0, windows.shape[0], PARAM_TORCH_BATCH)])
+
+def detect_scores(audio):
+    # Returns raw score of every token, or ONNX input windows that are
+    # evaluated by detect_batch
     if PARAM_MODE == "naive":
-        detected_voice = sound_detector(audio, 320, PARAM_SPEECH_NAIVE_TRESHOLD) # 320 is 20ms
+        detected_voice = audio[:audio.shape[-1] // 320 * 320].reshape(-1, 320).abs().max(dim=-1).values # 320 is 20ms, reshape works for short files too
     elif PARAM_MODE == "neural":
 
         # Pad data
-        audio = torch.nn.functional.pad(audio, (3200-320, 0), "constant", 0) # Pad zeros    
-        
-        # Compute log-mel spectrogram
-        window = torch.hann_window(400, device=audio.device)
-        stft = torch.stft(audio, 400, 160, window=window, return_complex=False)
-        magnitudes = torch.sum((stft ** 2), dim=-1)[..., :-1]
-        mel_spec = mel_filters.to(audio.device) @ magnitudes
-        log_spec = torch.clamp(mel_spec, min=1e-10).log10()
-
+        audio = torch.nn.functional.pad(audio, (PADDING, 0), "constant", 0) # Pad zeros    
 
         if PARAM_SPEECH_NEURAL_ENGINE == "torch":
-            # detected_voice = model(sliding_window(log_spec.to("mps"), 20, 2)).squeeze()
-            # detected_voice = detected_voice > PARAM_SPEECH_NEURAL_TRESHOLD
-            predictions = []
-            for i in range(3200, len(audio), 320):
-                predicted = model(audio[i-3200:i].unsqueeze(0))[0][0]
-                predictions.append(1 if predicted > PARAM_SPEECH_NEURAL_TRESHOLD else 0)
-            detected_voice = torch.tensor(predictions)
+            # 200ms windows ending at every 20ms, evaluated in batches
+            if audio.shape[0] < 3201: # Shorter than a window
+                return torch.zeros(0)
+            windows = audio[:-1].unfold(0, 3200, 320)
+            detected_voice = run_torch(windows)
         elif PARAM_SPEECH_NEURAL_ENGINE == "onnx":
-            batches = []
-            for i in range(20, log_spec.shape[1], 2):
-                batches.append(log_spec[:,i-20:i])
-            batches = torch.stack(batches)
-            predicted = onnx_session.run(["output"],{'input': batches.numpy()})[0]
-            detected_voice = (torch.tensor(predicted) > PARAM_SPEECH_NEURAL_TRESHOLD).int().squeeze()
-            # predictions = []
-            # for i in range(3200, len(audio), 320):
-            #     predicted = model(audio[i-3200:i].unsqueeze(0))[0][0]
-            #     predictions.append(1 if predicted > PARAM_SPEECH_NEURAL_TRESHOLD else 0)
-            # detected_voice = torch.tensor(predictions)
+            return onnx_windows(log_mel_spectrogram(audio))
     else:
         raise Exception("Invalid mode")
 
+    return detected_voice
+
+class StreamingDetector:
+    # Detector for audio that arrives in chunks of any size. Every push returns
+    # labels of the 20ms tokens that became complete, the same ones
+    # detect_scores gives for the whole audio. With ONNX only new mel frames
+    # are computed, the torch model takes raw 200ms windows.
+    def __init__(self, mode = PARAM_MODE, engine = PARAM_SPEECH_NEURAL_ENGINE):
+        self.mode = mode
+        self.engine = engine
+
+        # Same zero padding as detect_scores, ONNX also gets the left half of the
+        # first STFT frame (reflection of zeros is zeros)
+        padding = 0
+        if mode == "neural":
+            padding = PADDING + (200 if engine == "onnx" else 0)
+        self.buffer = torch.zeros(padding)
+        self.offset = 0 # Position of the buffer start in the padded stream
+        self.emitted = 0 # Tokens returned so far
+
+        # Mel frames that are not consumed yet, starting from frame 2 * emitted
+        self.spec = torch.zeros(80, 0)
+        self.computed = 0 # Number of computed mel frames
+
+    def push(self, audio):
+        return (self.scores(audio) > (PARAM_SPEECH_NAIVE_TRESHOLD if self.mode == "naive" else PARAM_SPEECH_NEURAL_TRESHOLD)).int()
+
+    def scores(self, audio):
+        # Raw scores of the new tokens
+        self.buffer = torch.cat([self.buffer, audio])
+        received = self.offset + self.buffer.shape[0]
+
+        if self.mode == "naive":
+            # Peak of every complete 320 sample frame
+            ready = received // 320
+            if ready <= self.emitted:
+                return torch.zeros(0)
+            predicted = self.buffer[:(ready - self.emitted) * 320].unfold(0, 320, 320).abs().max(dim=-1).values
+        elif self.engine == "torch":
+            # Window k is audio[320k:320k+3200] and needs one more sample after it
+            ready = max(0, (received - 3201) // 320 + 1)
+            if ready <= self.emitted:
+                return torch.zeros(0)
+            start = self.emitted * 320 - self.offset
+            windows = self.buffer[start:start + (ready - self.emitted - 1) * 320 + 3200].unfold(0, 3200, 320)
+            predicted = run_torch(windows)
+        elif self.engine == "onnx":
+            # Window k covers mel frames 2k...2k+19 and is complete when the
+            # whole file would have at least 2k+21 frames
+            ready = max(0, (received - 3560) // 320 + 1)
+            if ready <= self.emitted:
+                return torch.zeros(0)
+
+            # Compute only the new mel frames
+            frames = 2 * (ready - 1) + 20
+            segment = self.buffer[self.computed * 160 - self.offset:(frames - 1) * 160 + 400 - self.offset]
+            stft = torch.fft.rfft(segment.unfold(0, 400, 160) * get_window(), dim=-1)
+            magnitudes = (stft.real ** 2 + stft.imag ** 2).T
+            log_spec = torch.clamp(get_mel_filters() @ magnitudes, min=1e-10).log10()
+            self.spec = torch.cat([self.spec, log_spec], dim=1)
+            self.computed = frames
+
+            windows = self.spec.unfold(-1, 20, 2).permute(1, 0, 2)[:ready - self.emitted]
+            predicted = run_onnx([windows])[0]
+            self.spec = self.spec[:, 2 * (ready - self.emitted):]
+        else:
+            raise Exception("Invalid engine")
+
+        # Keep only audio that is needed for the next tokens
+        self.emitted = ready
+        keep = (self.computed * 160 if self.mode == "neural" and self.engine == "onnx" else ready * 320) - self.offset
+        self.buffer = self.buffer[keep:]
+        self.offset += keep
+
+        return predicted
+
+def detect_stream(path):
+    # Long files are read block by block, memory doesn't depend on their length
+    # apart from the scores (4 bytes per 20ms)
+    detector = StreamingDetector(PARAM_MODE, PARAM_SPEECH_NEURAL_ENGINE)
+    smoother = StreamingSmoother(PARAM_SPEECH_SMOOTH, 0.02) # 0.02 is 20ms
+    scores = []
+    intervals = []
+    length = 0
+    for block in load_audio_blocks(path, PARAM_STREAM_BLOCK):
+        length += block.shape[0]
+        predicted = detector.scores(block)
+        scores.append(predicted.numpy())
+        intervals += smoother.push((predicted > current_treshold()).int())
+    intervals += smoother.close()
+    if len(scores) == 0: # Empty file
+        return 0.0, torch.zeros(0, dtype=torch.float32), intervals
+    return length / SAMPLE_RATE, torch.from_numpy(np.concatenate(scores)), intervals
+
+def detect_batch(dir, files, durations, indices, features = None):
+    onnx = PARAM_MODE == "neural" and PARAM_SPEECH_NEURAL_ENGINE == "onnx"
+    results = []
+    streamed = []
+    for index in indices:
+        file = file_table_get(files, index)
+        if onnx and features is not None:
+            # Stored log-mel frames, the audio is not needed at all
+            results.append([file, int(features.lengths[index]) / SAMPLE_RATE, onnx_windows(features.get(index))])
+        elif durations[index] > PARAM_STREAM_MIN_DURATION:
+            streamed.append((file, *detect_stream(dir + file)))
+        else:
+            audio = load_audio(dir + file)
+            results.append([file, audio.shape[0] / SAMPLE_RATE, audio if onnx else detect_scores(audio)])
+
+    # Neural ONNX: spectrograms of all files are computed together and their
+    # windows go through the model together
+    if onnx:
+        missing = [r for r in results if r[2].dim() == 1]
+        if len(missing) > 0:
+            specs = log_mel_batch([torch.nn.functional.pad(r[2], (PADDING, 0)) for r in missing])
+            for r, spec in zip(missing, specs):
+                r[2] = onnx_windows(spec)
+        predicted = run_onnx([r[2] for r in results])
+        for r, p in zip(results, predicted):
+            r[2] = p
+
     # Convert to intervals
-    detected_voice = smooth_sound_detector(detected_voice, PARAM_SPEECH_SMOOTH)
+    return [(file, duration, scores, scores_to_intervals(scores, current_treshold(), PARAM_SPEECH_SMOOTH)) for file, duration, scores in results] + streamed
+
+def current_treshold():
+    return PARAM_SPEECH_NAIVE_TRESHOLD if PARAM_MODE == "naive" else PARAM_SPEECH_NEURAL_TRESHOLD
 
-    return files[index], duration, labels_to_intervals(detected_voice, 0.02) # 0.02 is 20ms
+def scores_to_intervals(scores, treshold, smooth):
+    detected_voice = smooth_sound_detector((scores > treshold).int(), smooth)
+    return labels_to_intervals(detected_voice, 0.02) # 0.02 is 20ms
 
-def detect_parallel(args):
-    dir, files, index = args
-    return detect_iter(dir, files, index)
+def detect_parallel(indices):
+    return detect_batch(worker_context['dir'], worker_context['files'], worker_context['durations'], indices, worker_context['features'])
 
 def run_detector(dir):
 
     # Indexing files
     print("Indexing files...")
-    files = [os.path.relpath(x, dir) for x in glob(dir + "**/*.wav", recursive=False)]
+    names = sorted(n for n in (os.path.relpath(x, dir) for x in list_files(dir)) if n.count("/") == 1) # Only files of split folders
+    files = create_file_table(names)
+    durations = np.array([frames / samplerate for frames, samplerate in audio_info([dir + n for n in names])])
 
-    # Detector loop
+    # Log-mel features are computed once and reused by next runs
+    features = None
+    if PARAM_FEATURE_STORE and PARAM_MODE == "neural" and PARAM_SPEECH_NEURAL_ENGINE == "onnx":
+        features = open_feature_store(dir, names, PADDING)
+        if features is None:
+            print("Computing features...")
+            features = build_feature_store(dir, names, PADDING)
+
+    # Detector loop, raw scores are kept for --sweep and --export
     print("Detecting...")
     output = {}
     total_duration = 0
     total_voice_duration = 0
     total_count = len(files)
-    if PARAM_WORKERS == 0:
-        for i in tqdm(range(len(files))):
-            file, duration, intervals = detect_iter(dir, files, i)
-            output[file] = intervals
-            total_duration += duration
-            for it in intervals:
-                total_voice_duration += it[1] - it[0]
-    else:
-        with multiprocessing.Manager() as manager:
-            files = manager.list(files)
-            args_list = [(dir, files, i) for i in range(len(files))]
-            with multiprocessing.Pool(processes=PARAM_WORKERS) as pool:
-                for result in tqdm(pool.imap_unordered(detect_parallel, args_list), total=len(files)):
-                    file, duration, intervals = result
+    scores_output = ScoreStoreWriter(dir + "scores/", names, { 'mode': PARAM_MODE, 'engine': PARAM_SPEECH_NEURAL_ENGINE })
+    batches = [range(i, min(i + PARAM_FILES_PER_TASK, len(files))) for i in range(0, len(files), PARAM_FILES_PER_TASK)]
+    with tqdm(total=len(files)) as progress:
+        if PARAM_WORKERS == 0:
+            for batch in batches:
+                for file, duration, scores, intervals in detect_batch(dir, files, durations, batch, features):
                     output[file] = intervals
+                    scores_output.append(file, duration, scores)
                     total_duration += duration
                     for it in intervals:
                         total_voice_duration += it[1] - it[0]
+                progress.update(len(batch))
+        else:
+            context = { 'dir': dir, 'files': files, 'durations': durations, 'features': features }
+            with multiprocessing.Pool(processes=PARAM_WORKERS, initializer=init_worker_context, initargs=(context,)) as pool:
+                for results in pool.imap_unordered(detect_parallel, batches):
+                    for file, duration, scores, intervals in results:
+                        output[file] = intervals
+                        scores_output.append(file, duration, scores)
+                        total_duration += duration
+                        for it in intervals:
+                            total_voice_duration += it[1] - it[0]
+                    progress.update(len(results))
+    scores_output.close()
 
     # Save results
-    with open(dir + "meta.json", "w") as outfile:
-            json.dump(output, outfile)
+    write_label_store(dir + "labels/", [file_table_get(files, i) for i in range(len(files))], output.items())
+    if PARAM_META_JSON:
+        write_meta_json(dir + "meta.json", LabelStore(dir + "labels/").records()) # Index order, same as export
     # if PARAM_MODE == "naive":
     #     with open(dir + "meta_naive.json", "w") as outfile:
     #         json.dump(output, outfile)
@@ -164,14 +353,78 @@ def run_detector(dir):
     print("Total duration: " + str(total_duration))
     print("Total voice duration: " + str(total_voice_duration))
     print("Total voice percentage: " + str(total_voice_duration / total_duration))
+#
+# Sweep over stored scores
+#
+
+def sweep_batches(store):
+    # Files of similar length are padded into [B, T] batches, padding never
+    # passes a treshold and trailing gaps are never filled by smoothing
+    lengths = store.ranges[:, 1] - store.ranges[:, 0]
+    order = np.argsort(lengths, kind='stable')
+    for i in range(0, len(order), PARAM_SWEEP_BATCH):
+        rows = order[i:i + PARAM_SWEEP_BATCH]
+        scores = torch.full((len(rows), max(1, int(lengths[rows].max()))), float("-inf"))
+        for j, row in enumerate(rows):
+            s = store.get(row)
+            scores[j, :s.shape[0]] = s
+        yield scores, torch.from_numpy(lengths[rows])
+
+def sweep(dir, tresholds = None, smooths = PARAM_SWEEP_SMOOTH):
+    store = ScoreStore(dir + "scores/")
+    if tresholds is None:
+        tresholds = PARAM_SWEEP_NAIVE_TRESHOLDS if store.info['mode'] == "naive" else PARAM_SWEEP_NEURAL_TRESHOLDS
+    total_duration = store.durations.sum()
+    voice = { (t, s): 0 for t in tresholds for s in smooths }
+    segments = { (t, s): 0 for t in tresholds for s in smooths }
+    for scores, lengths in tqdm(sweep_batches(store), total=(len(store) + PARAM_SWEEP_BATCH - 1) // PARAM_SWEEP_BATCH):
+        last = torch.clamp(lengths - 1, min=0).unsqueeze(1)
+        for t in tresholds:
+            detected = (scores > t).int()
+            for s in smooths:
+                smoothed = smooth_sound_detector_batch(detected, s)
+                starts = (smoothed[:, 1:] > smoothed[:, :-1]).sum() + (smoothed[:, 0] > 0).sum()
+                trailing = (smoothed.gather(1, last)[:, 0] * (lengths > 0)).sum()
 
+                # Same durations as intervals: ends point to the last voiced token,
+                # except for the interval that lasts until the end
+                voice[(t, s)] += float((smoothed.sum() - starts + trailing) * 0.02)
+                segments[(t, s)] += int(starts)
+
+    # Print results
+    print("Files: " + str(len(store)) + ", duration: " + str(total_duration) + ", mode: " + store.info['mode'] + " (" + store.info['engine'] + ")")
+    print("treshold\tsmooth\tvoice duration\tvoice percentage\tsegments")
+    for t in tresholds:
+        for s in smooths:
+            print(str(t) + "\t" + str(s) + "\t" + f'{voice[(t, s)]:.2f}' + "\t" + f'{voice[(t, s)] / total_duration:.4f}' + "\t" + str(segments[(t, s)]))
+
+def export(dir, treshold, smooth):
+    # Labels for another treshold and smoothing without running the detector
+    store = ScoreStore(dir + "scores/")
+    files = store.files()
+    output = {}
+    for i in tqdm(range(len(store))):
+        output[files[i]] = scores_to_intervals(store.get(i), treshold, smooth)
+    write_label_store(dir + "labels/", files, output.items())
+    if PARAM_META_JSON:
+        write_meta_json(dir + "meta.json", LabelStore(dir + "labels/").records()) # Index order, same as run_detector
 
 #
 # Running detector
 #
 
 if __name__ == "__main__":
-    print("Running detector on test set...")
-    run_detector(PARAM_SPEECH_DIR_TEST)
-    print("Running detector on train set...")
-    run_detector(PARAM_SPEECH_DIR_TRAIN)
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sweep", action="store_true", help="print statistics of treshold and smoothing combinations from stored scores")
+    parser.add_argument("--export", nargs=2, type=float, metavar=("TRESHOLD", "SMOOTH"), help="write labels for a treshold and smoothing from stored scores")
+    args = parser.parse_args()
+    for name, dir in [("test", PARAM_SPEECH_DIR_TEST), ("train", PARAM_SPEECH_DIR_TRAIN)]:
+        if args.sweep:
+            print("Sweeping " + name + " set...")
+            sweep(dir)
+        elif args.export is not None:
+            print("Exporting " + name + " set...")
+            export(dir, args.export[0], int(args.export[1]))
+        else:
+            print("Running detector on " + name + " set...")
+            run_detector(dir)
\ No newline at end of file
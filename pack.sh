@@ -10,5 +10,13 @@ tar --use-compress-program="pigz --best --recursive" -czvf $DATASETS_PATH/archiv
 tar --use-compress-program="pigz --best --recursive" -czvf $DATASETS_PATH/archive/non_speech.tar.gz -C $DATASETS_PATH/output non_speech
 tar --use-compress-program="pigz --best --recursive" -czvf $DATASETS_PATH/archive/speech_train.tar.gz -C $DATASETS_PATH/output speech_train
 tar --use-compress-program="pigz --best --recursive" -czvf $DATASETS_PATH/archive/speech_test.tar.gz -C $DATASETS_PATH/output speech_test
-tar --use-compress-program="pigz --best --recursive" -czvf $DATASETS_PATH/archive/vad_train.tar.gz -C $DATASETS_PATH/output vad_train
-tar --use-compress-program="pigz --best --recursive" -czvf $DATASETS_PATH/archive/vad_test.tar.gz -C $DATASETS_PATH/output vad_test
\ No newline at end of file
+
+# Synthesized sets written as tar shards are already packed and are just copied
+for SET in vad_train vad_test; do
+    if ls $DATASETS_PATH/output/$SET/*.tar > /dev/null 2>&1; then
+        mkdir -p $DATASETS_PATH/archive/$SET
+        cp -r $DATASETS_PATH/output/$SET/*.tar $DATASETS_PATH/output/$SET/meta.json* $DATASETS_PATH/output/$SET/labels $DATASETS_PATH/archive/$SET/
+    else
+        tar --use-compress-program="pigz --best --recursive" -czvf $DATASETS_PATH/archive/$SET.tar.gz -C $DATASETS_PATH/output $SET
+    fi
+done
\ No newline at end of file
@@ -1,13 +1,15 @@
 import os
 from tqdm import tqdm
-from glob import glob
 import random
 import torch
 from multiprocessing import Pool
-from utils import SAMPLE_RATE, load_audio, save_audio
+from utils import SAMPLE_RATE, load_audio, load_audio_blocks, resampled_length, save_audio, worker_context, init_worker_context, create_file_table, file_table_get, append_record, read_records, is_wav_complete, index_path
 import pathlib
+import numpy as np
+import soundfile as sf
 import multiprocessing
 from prepare_dns import load_dns_noise_with_voice
+from utils_index import list_files, audio_info
 
 #
 # Parameters
@@ -16,86 +18,157 @@ from prepare_dns import load_dns_noise_with_voice
 PARAM_MAX_DURATION = 5
 PARAM_MIN_DURATION = 0.5
 PARAM_WORKERS = multiprocessing.cpu_count()
+PARAM_RESUME = False # Continue an interrupted run instead of failing on existing directory
+PARAM_BLOCK_SIZE = SAMPLE_RATE * 10 # Samples read at once when splitting
 
 #
-# File split
+# Checkpoint
 #
 
-def split_files_iter(files, to, index, counter, lock):
-    # Load, remove channels and resample if needed
-    signal = load_audio(files[index])
-    duration = signal.shape[0] / SAMPLE_RATE
+def load_checkpoint(to, is_complete):
+    # Keep only records of fully written files, keyed by source index
+    records = {}
+    if not os.path.isfile(to + "checkpoint.jsonl"):
+        return records
+    with open(to + "checkpoint.jsonl.tmp", "w") as output:
+        for record in read_records(to + "checkpoint.jsonl"):
+            if record['index'] not in records and is_complete(record):
+                append_record(output, record)
+                records[record['index']] = record
+    os.replace(to + "checkpoint.jsonl.tmp", to + "checkpoint.jsonl")
+    return records
 
-    # Skip if too short
-    if duration < PARAM_MIN_DURATION:
-        return None
+#
+# File split
+#
 
-    # Calculate number of splits
-    target_duration = duration
-    splits = 1
+def plan_splits(length):
+    # Number of segments and length of all of them except the last one
+    duration = length / SAMPLE_RATE
+    if duration < PARAM_MIN_DURATION:
+        return 0, 0
     if PARAM_MAX_DURATION < duration:
         splits = int(duration // PARAM_MAX_DURATION)
         target_duration = duration / splits
+        return splits, int(SAMPLE_RATE * target_duration)
+    return 1, length
 
-    # Persist audio
-    for i in range(splits):
-
-        # Cut audio
-        audio = signal
-        if i != splits - 1:
-            audio = audio[0:int(SAMPLE_RATE * target_duration)]
-            signal = signal[int(SAMPLE_RATE * target_duration):]
+def read_source_blocks(path):
+    try:
+        info = sf.info(path)
+    except RuntimeError: # Format not supported by soundfile
+        return [load_audio(path).numpy()]
 
-        # Get file index
-        with lock:
-            id = counter.value
-            counter.value += 1
+    # 16 bit sources are copied as they are, without float conversion
+    if info.samplerate == SAMPLE_RATE and info.channels == 1 and info.subtype == 'PCM_16':
+        return sf.blocks(path, blocksize=PARAM_BLOCK_SIZE, dtype='int16')
 
-        # Create dir if needed
-        dir = f'{(id// 1000) * 1000:08d}'
-        pathlib.Path(to + dir).mkdir(parents=True, exist_ok=True)
+    # Remove channels and resample if needed
+    return (b.numpy() for b in load_audio_blocks(path, PARAM_BLOCK_SIZE))
 
-        # Save audio
-        fname = f'{dir}/{id:08d}.wav'
-        save_audio(to + fname, audio)
+def split_files_iter(files, to, index, first, length):
+    path = file_table_get(files, index)
+    duration = length / SAMPLE_RATE
 
-    return splits, duration
-
-def split_files_parallel(args):
-    files, to, index, counter, lock = args
-    return split_files_iter(files, to, index, counter, lock)
-
-def split_files(files, to):
+    # Skip if too short
+    splits, segment = plan_splits(length)
+    if splits == 0:
+        return { 'index': index, 'first': None, 'splits': 0, 'duration': duration }
+
+    # Read block by block and persist segments as soon as they are complete,
+    # the last one takes the rest
+    parts = []
+    filled = 0
+    total = 0
+    i = 0
+    for block in read_source_blocks(path):
+        total += block.shape[0]
+        while block.shape[0] > 0:
+            take = block if i == splits - 1 else block[:segment - filled]
+            parts.append(take)
+            filled += take.shape[0]
+            block = block[take.shape[0]:]
+            if i < splits - 1 and filled == segment:
+                save_split(to, first + i, parts)
+                parts = []
+                filled = 0
+                i += 1
+    if total != length or i != splits - 1:
+        raise Exception("Length of " + path + " doesn't match its header")
+    save_split(to, first + i, parts)
+
+    return { 'index': index, 'first': first, 'splits': splits, 'duration': duration }
+
+def save_split(to, id, parts):
+    # Create dir if needed
+    fname = index_path(id)
+    pathlib.Path(to + os.path.dirname(fname)).mkdir(parents=True, exist_ok=True)
+
+    # Save audio
+    save_audio(to + fname, np.concatenate(parts))
+
+def split_files_parallel(task):
+    return split_files_iter(worker_context['files'], worker_context['to'], *task)
+
+def remove_orphan_splits(to, records):
+    # Segments of source files that were not finished before interruption
+    ids = set()
+    for record in records.values():
+        if record['splits'] > 0:
+            ids.update(range(record['first'], record['first'] + record['splits']))
+    for dir in os.scandir(to):
+        if dir.is_dir():
+            for f in os.scandir(dir.path):
+                if f.name.endswith(".wav") and int(f.name[:-4]) not in ids:
+                    os.remove(f.path)
+
+def split_files(files, to, resume = PARAM_RESUME):
     
     # Check directory
+    records = {}
     if os.path.isdir(to):
-        raise Exception("Directory " + to + " already exist!")
-    os.mkdir(to)
+        if not resume:
+            raise Exception("Directory " + to + " already exist!")
+        print("Resuming...")
+    else:
+        os.mkdir(to)
+
+    # Every file gets its range of ids from lengths in headers, so ids don't
+    # depend on the order files are finished in and no lock is needed
+    print("Reading lengths...")
+    lengths = [resampled_length(frames, samplerate) for frames, samplerate in audio_info(files)]
+    firsts = np.cumsum([0] + [plan_splits(l)[0] for l in lengths])[:-1].tolist()
+
+    # Keep finished files, records of older runs with other ids are dropped
+    if resume:
+        records = load_checkpoint(to, lambda r: r['splits'] == 0 or (r['first'] == firsts[r['index']] and all(is_wav_complete(to + index_path(r['first'] + i)) for i in range(r['splits']))))
+        remove_orphan_splits(to, records)
 
     # Process all files
     total_duration = 0
     total_count = 0
-    if PARAM_WORKERS == 0:
-        counter = multiprocessing.Value('counter', 0)
-        lock = manager.Lock()
-        for i in tqdm(range(len(files))):
-            r = split_files_iter(files, to, i, counter, lock)
-            if r is not None:
-                splits, duration = r
-                total_duration = total_duration + duration
-                total_count = total_count + splits
-    else:
-        with multiprocessing.Manager() as manager:
-            files = manager.list(files)
-            counter = manager.Value('counter', 0)
-            lock = manager.Lock()
-            args_list = [(files, to, i, counter, lock) for i in range(len(files))]
-            with multiprocessing.Pool(processes=PARAM_WORKERS) as pool:
-                for result in tqdm(pool.imap_unordered(split_files_parallel, args_list), total=len(files)):
-                    if result is not None:
-                        splits, duration = result
-                        total_duration = total_duration + duration
-                        total_count = total_count + splits
+    for record in records.values():
+        if record['splits'] > 0:
+            total_duration = total_duration + record['duration']
+            total_count = total_count + record['splits']
+    pending = [(i, firsts[i], lengths[i]) for i in range(len(files)) if i not in records]
+    files = create_file_table(files)
+    with open(to + "checkpoint.jsonl", "a", buffering=1) as checkpoint:
+        if PARAM_WORKERS == 0:
+            for task in tqdm(pending):
+                result = split_files_iter(files, to, *task)
+                append_record(checkpoint, result)
+                if result['splits'] > 0:
+                    total_duration = total_duration + result['duration']
+                    total_count = total_count + result['splits']
+        else:
+            context = { 'files': files, 'to': to }
+            with multiprocessing.Pool(processes=PARAM_WORKERS, initializer=init_worker_context, initargs=(context,)) as pool:
+                for result in tqdm(pool.imap_unordered(split_files_parallel, pending), total=len(pending)):
+                    append_record(checkpoint, result)
+                    if result['splits'] > 0:
+                        total_duration = total_duration + result['duration']
+                        total_count = total_count + result['splits']
     
     # Return result
     return total_count, total_duration
@@ -106,7 +179,7 @@ def split_files(files, to):
 
 def process_impulse_iter(files, to, index):
     # Load, remove channels and resample if needed
-    signal = load_audio(files[index])
+    signal = load_audio(file_table_get(files, index))
 
     # Find peak index
     _, direct_index = signal.abs().max(axis=0, keepdim=True)
@@ -124,39 +197,46 @@ def process_impulse_iter(files, to, index):
     duration = signal.shape[0] / SAMPLE_RATE
 
     # Create dir if needed
-    dir = f'{(index// 1000) * 1000:08d}'
-    pathlib.Path(to + dir).mkdir(parents=True, exist_ok=True)
+    fname = index_path(index)
+    pathlib.Path(to + os.path.dirname(fname)).mkdir(parents=True, exist_ok=True)
 
     # Persist audio
-    fname = f'{dir}/{index:08d}.wav'
     save_audio(to + fname, signal)
 
-    return  duration
+    return { 'index': index, 'duration': duration }
 
-def process_impulse_parallel(args):
-    files, to, i = args
-    return process_impulse_iter(files, to, i)
+def process_impulse_parallel(index):
+    return process_impulse_iter(worker_context['files'], worker_context['to'], index)
 
-def process_impulse(files, to):
+def process_impulse(files, to, resume = PARAM_RESUME):
     
     # Check directory
+    records = {}
     if os.path.isdir(to):
-        raise Exception("Directory " + to + " already exist!")
-    pathlib.Path(to).mkdir(parents=True, exist_ok=True)
+        if not resume:
+            raise Exception("Directory " + to + " already exist!")
+        print("Resuming...")
+        records = load_checkpoint(to, lambda r: is_wav_complete(to + index_path(r['index'])))
+    else:
+        pathlib.Path(to).mkdir(parents=True, exist_ok=True)
 
     # Process all files
-    total_duration = 0
+    total_duration = sum(r['duration'] for r in records.values())
     total_count = len(files)
-    if PARAM_WORKERS == 0:
-        for i in tqdm(range(len(files))):
-            total_duration += process_impulse_iter(files, to, i)
-    else:
-        with multiprocessing.Manager() as manager:
-            files = manager.list(files)
-            args_list = [(files, to, i) for i in range(len(files))]
-            with multiprocessing.Pool(processes=PARAM_WORKERS) as pool:
-                for result in tqdm(pool.imap_unordered(process_impulse_parallel, args_list), total=len(files)):
-                    total_duration += result
+    pending = [i for i in range(total_count) if i not in records]
+    files = create_file_table(files)
+    with open(to + "checkpoint.jsonl", "a", buffering=1) as checkpoint:
+        if PARAM_WORKERS == 0:
+            for i in tqdm(pending):
+                result = process_impulse_iter(files, to, i)
+                append_record(checkpoint, result)
+                total_duration += result['duration']
+        else:
+            context = { 'files': files, 'to': to }
+            with multiprocessing.Pool(processes=PARAM_WORKERS, initializer=init_worker_context, initargs=(context,)) as pool:
+                for result in tqdm(pool.imap_unordered(process_impulse_parallel, pending), total=len(pending)):
+                    append_record(checkpoint, result)
+                    total_duration += result['duration']
     
     # Return result
     return total_count, total_duration
@@ -172,18 +252,10 @@ def list_all_files(rules):
         patterns = ["*.wav"]
         if 'patterns' in d:
             patterns = d['patterns']
-        for pattern in patterns:
-                found = glob(path + "**/" + pattern, recursive=True)
-                if 'ignore' in d:
-                    filtered = []
-                    for f in found:
-                        f = f[len(path):]
-                        if f not in d['ignore']:
-                            filtered.append(path + f)
-                        # else:
-                        #     print("Ignoring: ", f)
-                    found = filtered
-                wav.extend(found)
+        ignore = d['ignore'] if 'ignore' in d else None
+        if callable(ignore): # Evaluated only when the directory is listed
+            ignore = ignore()
+        wav.extend(list_files(path, patterns, ignore))
     return wav
 
 
@@ -243,7 +315,7 @@ if __name__ == "__main__":
         { 'path': "./dataset/source/source_voices_release/distant-16k/distractors/rm4/musi/" },
         { 'path': "./dataset/source/source_voices_release/distant-16k/distractors/rm4/none/" },
 
-        { 'path': "./dataset/source/source_dns_challenge_4/noise_fullband/", 'ignore': load_dns_noise_with_voice() }, # Some noises are with voice
+        { 'path': "./dataset/source/source_dns_challenge_4/noise_fullband/", 'ignore': load_dns_noise_with_voice }, # Some noises are with voice
         
         { 'path': "./dataset/source/source_urban_mixture/recordings/" }
     ]
@@ -1,6 +1,17 @@
 from glob import glob
+import os
 import requests
 import csv
+import sqlite3
+
+#
+# Parameters
+#
+
+PARAM_SEGMENTS_URL = "http://storage.googleapis.com/us_audioset/youtube_corpus/v1/csv/unbalanced_train_segments.csv"
+PARAM_SEGMENTS_CSV = "./dataset/source/unbalanced_train_segments.csv" # Local copy, downloaded if missing
+PARAM_SEGMENTS_INDEX = "./dataset/source/unbalanced_train_segments.sqlite" # Parsed labels keyed by YouTube id
+INDEX_VERSION = 1 # Bump when the index layout changes
 
 labels_to_ignore = ['/m/09x0r',
                     '/m/05zppz',
@@ -18,35 +29,80 @@ labels_to_ignore = ['/m/09x0r',
                     '/m/07c52', 
                     '/m/06bz3']
 
-def load_dns_noise_with_voice():
+#
+# Segments index
+#
 
-    # Download segments index
+def download_segments():
     print("Downloading unbalanced_train_segments.csv...")
-    segments = requests.get("http://storage.googleapis.com/us_audioset/youtube_corpus/v1/csv/unbalanced_train_segments.csv")
-    segments = segments.text
-    ignored = {}
-    for i in segments.split("\n")[3:-1]:
-        l = i.split(",", maxsplit=3)
-        name = l[0].strip()
-        labels = l[3].strip().strip('"').split(',')
-        should_ignore = False
-        for j in labels:
-            if j in labels_to_ignore:
-                should_ignore = True
-                break
-        if should_ignore:
-            ignored[name] = True
+    segments = requests.get(PARAM_SEGMENTS_URL)
+    segments.raise_for_status()
+    with open(PARAM_SEGMENTS_CSV + ".tmp", "wb") as f:
+        f.write(segments.content)
+    os.replace(PARAM_SEGMENTS_CSV + ".tmp", PARAM_SEGMENTS_CSV)
+
+def read_segments(path):
+    # Rows are "YTID, start_seconds, end_seconds, positive_labels" after three comment lines
+    with open(path, "r", newline="") as f:
+        for row in csv.reader(f, skipinitialspace=True):
+            if len(row) < 4 or row[0].startswith("#"):
+                continue
+            yield row[0].strip(), row[3].strip()
+
+def build_segments_index():
+    if not os.path.isfile(PARAM_SEGMENTS_CSV):
+        download_segments()
+    print("Indexing unbalanced_train_segments.csv...")
+    tmp = PARAM_SEGMENTS_INDEX + ".tmp"
+    if os.path.isfile(tmp):
+        os.remove(tmp)
+    db = sqlite3.connect(tmp)
+    db.execute("CREATE TABLE info (key TEXT PRIMARY KEY, value TEXT)")
+    db.execute("CREATE TABLE segments (ytid TEXT, labels TEXT)")
+    db.executemany("INSERT INTO segments VALUES (?, ?)", read_segments(PARAM_SEGMENTS_CSV))
+    db.execute("CREATE INDEX segments_ytid ON segments (ytid)")
+    db.execute("INSERT INTO info VALUES ('version', ?)", (str(INDEX_VERSION),))
+    db.commit()
+    db.close()
+    os.replace(tmp, PARAM_SEGMENTS_INDEX)
+
+def open_segments_index():
+    # Built once from the local csv, the network is needed only if there is no copy
+    if os.path.isfile(PARAM_SEGMENTS_INDEX):
+        db = sqlite3.connect(PARAM_SEGMENTS_INDEX)
+        try:
+            version = db.execute("SELECT value FROM info WHERE key = 'version'").fetchone()
+        except sqlite3.DatabaseError:
+            version = None
+        if version is not None and version[0] == str(INDEX_VERSION):
+            return db
+        db.close()
+        print("Segments index is outdated, rebuilding...")
+    build_segments_index()
+    return sqlite3.connect(PARAM_SEGMENTS_INDEX)
+
+def load_dns_noise_with_voice():
 
     # List all files
     files = glob("./dataset/source/source_dns_challenge_4/noise_fullband/*.wav")
     files = [f.split("/")[-1] for f in files]
     files = [f.split(".")[0] for f in files]
 
+    # Look up labels of listed files only
+    ignore = set(labels_to_ignore)
+    ignored = set()
+    db = open_segments_index()
+    try:
+        for i in range(0, len(files), 500): # Sqlite limits the number of variables
+            chunk = files[i:i + 500]
+            for name, labels in db.execute("SELECT ytid, labels FROM segments WHERE ytid IN (" + ",".join("?" * len(chunk)) + ")", chunk):
+                if not ignore.isdisjoint(labels.split(',')):
+                    ignored.add(name)
+    finally:
+        db.close()
+
     # Filter files
-    to_ignore = []
-    for i in files:
-        if i in ignored:
-            to_ignore.append(i)
+    to_ignore = [i for i in files if i in ignored]
 
     # Add extension
     to_ignore = [f + ".wav" for f in to_ignore]
@@ -56,4 +112,4 @@ def load_dns_noise_with_voice():
 if __name__ == "__main__":
     ignored = load_dns_noise_with_voice()
     print(len(ignored))
-    print(ignored[0])
\ No newline at end of file
+    print(ignored[0])
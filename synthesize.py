@@ -1,13 +1,15 @@
 import os
-from tqdm import tqdm
-from glob import glob
 import random
 import json
-import torchaudio
-from torchaudio.io import CodecConfig
-from utils import labels_to_intervals, SAMPLE_RATE, load_audio, save_audio
-from utils_synth import synthesize_sample, resolve, sequental, one_of, maybe
+import argparse
+import tarfile
+from tqdm import tqdm
+from glob import glob
+from utils import labels_to_intervals, SAMPLE_RATE, save_audio, worker_context, init_worker_context, append_meta, read_meta, write_meta_json, is_wav_complete, index_path, shard_path, encode_audio, tar_add
+from utils_synth import ffmpeg_effector, synthesize_batch, resolve, sequental, one_of, maybe, sample_rng
+from utils_store import LabelStore, open_store, list_source_files, write_label_store, SourceFiles, source_frames
 import multiprocessing
+import numpy as np
 
 #
 # Parameters
@@ -18,6 +20,16 @@ PARAM_DURATION = 5
 PARAM_COUNT = 2000000
 PARAM_COUNT_TEST = 50000
 PARAM_WORKERS = multiprocessing.cpu_count()
+PARAM_BATCH_SIZE = 32 # Number of samples rendered together
+PARAM_CHUNK_SIZE = 2 # Number of batches sent to a worker at once
+PARAM_SEED = 42 # Every sample is seeded from this, its split and its index
+PARAM_RESUME = False # Continue an interrupted run instead of failing on existing directory
+PARAM_SOURCE_STORE = True # Read sources from pre-decoded stores (utils_store.py) when they are available
+PARAM_PLAN_ORDER = None # Plan columns to group rendering by, e.g. ['codec', 'effect']
+PARAM_DSP_BACKEND = "ffmpeg" # "ffmpeg" or "torch" (phase vocoder tempo and biquad filters, codecs still use ffmpeg)
+PARAM_OUTPUT_FORMAT = "wav" # "wav" (file per sample) or "tar" (WebDataset-style tar per 1000 samples)
+PARAM_OUTPUT_AUDIO = "wav" # Audio encoding of samples in tar shards, "wav" or "flac" (lossless, smaller)
+PARAM_META_JSON = True # Also write legacy meta.json next to the label store
 
 # Speech parameters
 PARAM_SPEECH_PROB = 0.5 # Probability of speech presence
@@ -38,17 +50,17 @@ PARAM_CODECS = [
     {'format': "g722"}, # Popular in VoIP
     # {'format': "ogg", 'encoder': "opus", ""}, # Still experimental?
 
-    # NOTE: If you have compiler crash on this line, try to install ffmpeg in your system
-    {"format": "mp3", "codec_config": CodecConfig(bit_rate=8_000)}, # Low quality
-    {"format": "mp3", "codec_config": CodecConfig(bit_rate=64_000)} # Average quality
+    # NOTE: If you have compiler crash on these codecs, try to install ffmpeg in your system
+    {"format": "mp3", "codec_config": { 'bit_rate': 8_000 }}, # Low quality, codec_config holds CodecConfig arguments
+    {"format": "mp3", "codec_config": { 'bit_rate': 64_000 }} # Average quality
 ]
 
 # Effects
 PARAM_EFFECTS_PROB = 0.8
 PARAM_EFFECTS = sequental(
     one_of( # Multiple filters could corrupt audio too badly
-        maybe(lambda:f'lowpass=frequency={random.randint(400, 1500)}:poles=1', 0.3),
-        maybe(lambda:f'highpass=frequency={random.randint(2000, 4000)}', 0.3),
+        maybe(lambda rng:f'lowpass=frequency={rng.randint(400, 1500)}:poles=1', 0.3),
+        maybe(lambda rng:f'highpass=frequency={rng.randint(2000, 4000)}', 0.3),
         maybe("bandpass=frequency=3000", 0.3)
     )
 )
@@ -57,128 +69,371 @@ PARAM_EFFECTS = sequental(
 PARAM_RIR_PROB = 0.5 # Probability of RIR presence
 PARAM_RIR_REAL_PROB = 0.3 # Probability of real RIR instead of synthetic
 #
-# Synthesizer
+# Sources
+#
+
+def index_sources(source_dir, windows = False):
+    # With windows, frame counts are indexed so that only used parts are read
+    files = list_source_files(source_dir)
+    if PARAM_SOURCE_STORE:
+        store = open_store(source_dir, files)
+        if store is not None:
+            return store
+    return SourceFiles(files, source_frames(files) if windows else None)
+
+#
+# Planning: all random decisions of a sample, without touching audio
 #
 
-def synthesize_iter(to, speech_files, background_files, rir_real_files, rir_files, index):
+PLAN_COLUMNS = {
+    'index': np.int64,
+    'speech': np.int32, # -1 if there is no speech
+    'speech_tempo': np.float64,
+    'background': np.int32, # -1 if there is no background
+    'background_snr': np.float64,
+    'rir': np.int32, # -1 if there is no RIR
+    'rir_real': np.bool_,
+    'codec': np.int8, # Index in PARAM_CODECS, -1 if there is no codec
+    'effect': np.int32, # Index in the effects vocabulary, -1 if there is no effect
+    'seed': np.int64 # Seed of the offsets
+}
+
+def plan_sample(split, counts, index):
+    # Each sample owns its random stream, so it does not depend on worker scheduling
+    rng = sample_rng(PARAM_SEED, split, index)
+
     # Parts
-    clean = None
-    background = None
-    background_snr = random.uniform(PARAM_BACKGROUND_MIN_SNR, PARAM_BACKGROUND_MAX_SNR)
-    rir = None
-    effector = None
-    speech_tempo = random.uniform(PARAM_SPEECH_TEMPO_MIN, PARAM_SPEECH_TEMPO_MAX)
-    codec = None
-    effect = None
-    effector = None
+    row = { 'index': index, 'speech': -1, 'background': -1, 'rir': -1, 'rir_real': False, 'codec': -1, 'effect': None }
+    row['background_snr'] = rng.uniform(PARAM_BACKGROUND_MIN_SNR, PARAM_BACKGROUND_MAX_SNR)
+    row['speech_tempo'] = rng.uniform(PARAM_SPEECH_TEMPO_MIN, PARAM_SPEECH_TEMPO_MAX)
 
     # Add speech
-    if random.random() < PARAM_SPEECH_PROB:
-        clean = load_audio(random.choice(speech_files))
+    if rng.random() < PARAM_SPEECH_PROB:
+        row['speech'] = rng.randrange(counts['speech'])
             
     # Add background
-    if (random.random() < PARAM_BACKGROUND_PROB or clean is None): # Always pick background if no speech is present
-        background = load_audio(random.choice(background_files))
+    if (rng.random() < PARAM_BACKGROUND_PROB or row['speech'] < 0): # Always pick background if no speech is present
+        row['background'] = rng.randrange(counts['background'])
 
     # Add rir
-    if rir_files is not None and random.random() < PARAM_RIR_PROB:
-        if random.random() < PARAM_RIR_REAL_PROB:
-            rir = load_audio(random.choice(rir_real_files))
-        else:
-            rir = load_audio(random.choice(rir_files))
+    if rng.random() < PARAM_RIR_PROB:
+        row['rir_real'] = rng.random() < PARAM_RIR_REAL_PROB
+        row['rir'] = rng.randrange(counts['rir_real'] if row['rir_real'] else counts['rir'])
 
     # Add codec
-    if random.random() < PARAM_CODECS_PROB:
-        codec = random.choice(PARAM_CODECS)
+    if rng.random() < PARAM_CODECS_PROB:
+        row['codec'] = rng.randrange(len(PARAM_CODECS))
             
     # Add effect
-    if PARAM_EFFECTS is not None and random.random() < PARAM_EFFECTS_PROB:
-        effect = resolve(PARAM_EFFECTS)
-
-    # Create effector
-    if effect is not None or codec is not None:
-        args = {}
-        if effect is not None:
-            args['effect'] = effect
-        if codec is not None:
-            args.update(codec)
-        effector = torchaudio.io.AudioEffector(**args)
+    if PARAM_EFFECTS is not None and rng.random() < PARAM_EFFECTS_PROB:
+        row['effect'] = resolve(PARAM_EFFECTS, rng)
+
+    # Offsets are picked when rendering from their own stream
+    row['seed'] = rng.getrandbits(63)
+
+    return row
+
+def plan_samples(split, counts, indices, progress = True):
+    # Columnar table, effect strings are stored once in a vocabulary
+    plan = { k: np.zeros(len(indices), dtype=t) for k, t in PLAN_COLUMNS.items() }
+    effects = {}
+    for j, index in enumerate(tqdm(indices, disable=not progress)):
+        row = plan_sample(split, counts, index)
+        if row['effect'] is None:
+            row['effect'] = -1
+        else:
+            row['effect'] = effects.setdefault(row['effect'], len(effects))
+        for k in PLAN_COLUMNS:
+            plan[k][j] = row[k]
+    plan['effects'] = np.array(list(effects.keys()) if len(effects) > 0 else [''], dtype=np.str_)
+    return plan
+
+def save_plan(path, plan):
+    with open(path, "wb") as f:
+        np.savez(f, **plan)
+
+def load_plan(path):
+    with np.load(path) as f:
+        return { k: f[k] for k in f.files }
+
+def describe_plan(plan):
+    count = max(plan['index'].shape[0], 1)
+    print("Samples: ", plan['index'].shape[0])
+    print("With speech: ", (plan['speech'] >= 0).sum() / count)
+    print("With background: ", (plan['background'] >= 0).sum() / count)
+    print("With RIR: ", (plan['rir'] >= 0).sum() / count, " real: ", ((plan['rir'] >= 0) & plan['rir_real']).sum() / count)
+    print("With codec: ", (plan['codec'] >= 0).sum() / count)
+    print("With effect: ", (plan['effect'] >= 0).sum() / count, " distinct: ", np.unique(plan['effect'][plan['effect'] >= 0]).shape[0])
+
+def order_plan(plan, rows):
+    # Group rows with the same columns together, e.g. the same effector configuration
+    if PARAM_PLAN_ORDER is None or len(rows) == 0:
+        return rows
+    rows = np.array(rows)
+    keys = [plan[k][rows] for k in reversed(PARAM_PLAN_ORDER)]
+    return rows[np.lexsort(keys)].tolist()
+
+#
+# Rendering
+#
+
+def create_effector(codec, effect):
+    if effect is None and codec < 0:
+        return None
+    args = {}
+    if effect is not None:
+        args['effect'] = effect
+    if codec >= 0:
+        args.update(PARAM_CODECS[codec])
+    return ffmpeg_effector(**args)
+
+def render_recipe(plan, sources, row):
+    speech = plan['speech'][row]
+    background = plan['background'][row]
+    rir = plan['rir'][row]
+    codec = plan['codec'][row]
+    effect = str(plan['effects'][plan['effect'][row]]) if plan['effect'][row] >= 0 else None
+
+    # Arguments of synthesize_sample
+    return {
+        # Effect: with torch backend filters are applied in torch before the codec
+        'effector': create_effector(codec, effect if PARAM_DSP_BACKEND == "ffmpeg" else None),
+        'effect': effect if PARAM_DSP_BACKEND == "torch" else None,
+
+        # Background
+        'background': sources['background'].window(background) if background >= 0 else None, # Offset is picked from the length first
+        'background_snr': float(plan['background_snr'][row]),
+
+        # Clean voice
+        'clean': sources['speech'].get(speech) if speech >= 0 else None,
+        'clean_treshold': PARAM_SPEECH_TRESHOLD,
+        'clean_smooth': PARAM_SPEECH_SMOOTH,
+        'clean_tempo': float(plan['speech_tempo'][row]),
+
+        # RIR
+        'rir': (sources['rir_real'] if plan['rir_real'][row] else sources['rir']).get(rir) if rir >= 0 else None,
+
+        # Offsets
+        'rng': random.Random(int(plan['seed'][row]))
+    }
+
+def render_samples(plan, sources, rows):
+    recipes = [render_recipe(plan, sources, row) for row in rows]
+    return synthesize_batch(PARAM_DURATION, recipes, PARAM_DSP_BACKEND)
 
+def render_batch(plan, sources, rows):
+    samples, labels = render_samples(plan, sources, rows)
+    return [(int(plan['index'][row]), sample, labels_to_intervals(l, 0.02)) for row, sample, l in zip(rows, samples, labels)] # 20ms tokens
+
+def synthesize_iter(to, plan, sources, rows):
     # Do synthesizing
-    sample, labels = synthesize_sample(PARAM_DURATION, 
-                                        # Effect
-                                        effector=effector,
-                                        
-                                        # Background
-                                        background=background, 
-                                        background_snr=background_snr,
-
-                                        # Clean voice
-                                        clean=clean,
-                                        clean_treshold=PARAM_SPEECH_TRESHOLD,
-                                        clean_smooth=PARAM_SPEECH_SMOOTH,
-                                        clean_tempo=speech_tempo,
-
-                                        # RIR
-                                        rir=rir)
-
-    # Create dir if needed
-    dir = f'{(index // 1000) * 1000:08d}'
-    fname = f'{dir}/{index:08d}.wav'
-    labels = labels_to_intervals(labels, 0.02) # 20ms tokens
-    save_audio(to + fname, sample)
+    results = []
+    for index, sample, labels in render_batch(plan, sources, rows):
+        fname = index_path(index)
+        save_audio(to + fname, sample)
+        results.append((fname, labels))
+
+    # Return result
+    return results
+
+def synthesize_shard_iter(to, plan, sources, rows):
+    # A whole folder is rendered by one worker into a single tar, it becomes
+    # visible only when complete
+    path = to + shard_path(int(plan['index'][rows[0]]))
+    results = []
+    with tarfile.open(path + ".tmp", "w") as tar:
+        for i in range(0, len(rows), PARAM_BATCH_SIZE):
+            for index, sample, labels in render_batch(plan, sources, rows[i:i + PARAM_BATCH_SIZE]):
+                tar_add(tar, f'{index:08d}.{PARAM_OUTPUT_AUDIO}', encode_audio(sample, PARAM_OUTPUT_AUDIO))
+                tar_add(tar, f'{index:08d}.json', json.dumps({ 'labels': labels }).encode('utf-8'))
+                results.append((index_path(index), labels))
+    os.replace(path + ".tmp", path)
 
     # Return result
-    return fname, labels
+    return results
 
-def synthesize_parallel(args):
-    to, speech_files, background_files, rir_real_files, rir_files, i = args
-    return synthesize_iter(to, speech_files, background_files, rir_real_files, rir_files, i)
+def synthesize_parallel(rows):
+    if PARAM_OUTPUT_FORMAT == "tar":
+        return synthesize_shard_iter(worker_context['to'], worker_context['plan'], worker_context['sources'], rows)
+    return synthesize_iter(worker_context['to'], worker_context['plan'], worker_context['sources'], rows)
 
+def is_sample_complete(to, fname):
+    # In tar mode records name the sample inside its folder's tar
+    if PARAM_OUTPUT_FORMAT == "tar":
+        return os.path.isfile(to + fname.split("/")[0] + ".tar")
+    return is_wav_complete(to + fname)
 
-def synthesize(to, speech_dir, background_dir, rir_real_dir, rir_dir, count = PARAM_COUNT):
+def load_completed(to, meta, start, end):
+    # Keep only records whose audio is fully written and drop everything else
+    completed = set()
+    if not os.path.isfile(to + meta):
+        return completed
+    for fname, labels in read_meta(to + meta):
+        if fname not in completed and is_sample_complete(to, fname):
+            completed.add(fname)
+
+    # A tar is renamed into place before its records are appended, a folder
+    # with missing records is rendered again as a whole
+    if PARAM_OUTPUT_FORMAT == "tar":
+        found = {}
+        for fname in completed:
+            folder = int(fname.split("/")[0])
+            found[folder] = found.get(folder, 0) + 1
+        full = { f for f, n in found.items() if n == min(end, (f + 1) * 1000) - max(start, f * 1000) }
+        completed = { fname for fname in completed if int(fname.split("/")[0]) in full }
+
+    # Rewrite
+    written = set()
+    with open(to + meta + ".tmp", "w") as output:
+        for fname, labels in read_meta(to + meta):
+            if fname in completed and fname not in written:
+                append_meta(output, fname, labels)
+                written.add(fname)
+    os.replace(to + meta + ".tmp", to + meta)
+    return completed
+
+#
+# Sharding
+#
+
+def shard_range(shard, shards, count):
+    # Shards own whole 1000-sample directories, so slices never share a folder
+    dirs = (count + 999) // 1000
+    start = (shard * dirs // shards) * 1000
+    end = min(((shard + 1) * dirs // shards) * 1000, count)
+    return start, end
+
+def shard_name(shard, shards):
+    return f'{shard}-of-{shards}'
+
+def synthesize(to, speech_dir, background_dir, rir_real_dir, rir_dir, count = PARAM_COUNT, split = "train", shard = None, resume = PARAM_RESUME, plan_only = False):
+
+    # Resolve slice
+    start, end = 0, count
+    suffix = ""
+    if shard is not None:
+        start, end = shard_range(shard[0], shard[1], count)
+        suffix = "." + shard_name(shard[0], shard[1])
+    meta = "meta" + suffix + ".jsonl"
 
     # Check directory
-    if os.path.isdir(to):
-        raise Exception("Directory " + to + " already exist!")
-    os.mkdir(to)
+    completed = set()
+    if plan_only:
+        os.makedirs(to, exist_ok=True)
+    elif os.path.isfile(to + meta) or (shard is None and os.path.isdir(to)):
+        if not resume:
+            raise Exception("Directory " + to + " already exist!")
+        print("Resuming...")
+        completed = load_completed(to, meta, start, end)
+    else:
+        os.makedirs(to, exist_ok=True)
+
+    # Write shard manifest
+    if shard is not None:
+        with open(to + "shard" + suffix + ".json", "w") as f:
+            json.dump({ 'split': split, 'seed': PARAM_SEED, 'count': count, 'shard': shard[0], 'shards': shard[1], 'start': start, 'end': end }, f)
 
     # Speech
     print("Indexing files...")
-    speech_files = glob(speech_dir + "**/*.wav", recursive=True)
-    background_files = glob(background_dir + "**/*.wav", recursive=True)
-    rir_files = glob(rir_dir + "**/*.wav", recursive=True)
-    rir_real_files = glob(rir_real_dir + "**/*.wav", recursive=True)
-
-    # Create folders
-    print("Creating folders...")
-    for i in range(0, count, 1000):
-        dir = f'{i:08d}'
-        if not os.path.isdir(to + dir):
-            os.mkdir(to + dir)
-
-    # Synthesizing loop
-    print("Synthesizing...")
-    output = {}
-    if PARAM_WORKERS == 0:
-        for i in tqdm(range(count)):
-            fname, labels = synthesize_iter(to, speech_files, background_files, rir_real_files, rir_files, i)
-            output[fname] = labels
+    sources = {
+        'speech': index_sources(speech_dir),
+        'background': index_sources(background_dir, windows=True),
+        'rir': index_sources(rir_dir),
+        'rir_real': index_sources(rir_real_dir)
+    }
+
+    # Plan every sample of the slice, it is deterministic and the same on resume
+    print("Planning...")
+    plan = plan_samples(split, { k: len(v) for k, v in sources.items() }, range(start, end))
+    save_plan(to + "plan" + suffix + ".npz", plan)
+    describe_plan(plan)
+    if plan_only:
+        return
+    pending = order_plan(plan, [j for j in range(end - start) if index_path(start + j) not in completed])
+    if PARAM_OUTPUT_FORMAT == "tar":
+        # Task is a whole folder, unfinished ones are rendered again from scratch (see load_completed)
+        folders = {}
+        for row in pending:
+            folders.setdefault(int(plan['index'][row]) // 1000, []).append(row)
+        batches = list(folders.values())
+        chunksize = 1
     else:
-        with multiprocessing.Manager() as manager:
-            speech_files = manager.list(speech_files)
-            background_files = manager.list(background_files)
-            rir_files = manager.list(rir_files)
-            rir_real_files = manager.list(rir_real_files)
-            args_list = [(to, speech_files, background_files, rir_real_files, rir_files, i) for i in range(count)]
-            with multiprocessing.Pool(processes=PARAM_WORKERS) as pool:
-                for result in tqdm(pool.imap_unordered(synthesize_parallel, args_list), total=count):
-                    fname, labels = result
-                    output[fname] = labels
-    
+        batches = [pending[i:i + PARAM_BATCH_SIZE] for i in range(0, len(pending), PARAM_BATCH_SIZE)]
+        chunksize = PARAM_CHUNK_SIZE
+
+        # Create folders
+        print("Creating folders...")
+        for i in range(start, end, 1000):
+            dir = f'{i:08d}'
+            if not os.path.isdir(to + dir):
+                os.mkdir(to + dir)
+
+    # Synthesizing loop: labels are appended to meta.jsonl as they arrive
+    print("Synthesizing...")
+    with open(to + meta, "a", buffering=1) as output, tqdm(total=len(pending)) as progress:
+        if PARAM_WORKERS == 0:
+            worker = synthesize_shard_iter if PARAM_OUTPUT_FORMAT == "tar" else synthesize_iter
+            for batch in batches:
+                for fname, labels in worker(to, plan, sources, batch):
+                    append_meta(output, fname, labels)
+                progress.update(len(batch))
+        else:
+            context = {
+                'to': to,
+                'plan': plan,
+                'sources': sources
+            }
+            with multiprocessing.Pool(processes=PARAM_WORKERS, initializer=init_worker_context, initargs=(context,)) as pool:
+                for results in pool.imap_unordered(synthesize_parallel, batches, chunksize=chunksize):
+                    for fname, labels in results:
+                        append_meta(output, fname, labels)
+                    progress.update(len(results))
+
+    # Output (shards are combined by merge)
+    if shard is None:
+        write_labels(to, count)
+
+def write_labels(to, count):
+    # Label store is indexed by sample index
+    write_label_store(to + "labels/", [index_path(i) for i in range(count)], read_meta(to + "meta.jsonl"))
+    if PARAM_META_JSON:
+        # From the store, so that it is in index order like utils_store.py --labels writes it
+        write_meta_json(to + "meta.json", LabelStore(to + "labels/").records())
+
+def merge(to, count = PARAM_COUNT, split = "train"):
+
+    # Load manifests
+    manifests = []
+    for path in glob(to + "shard.*-of-*.json"):
+        with open(path, "r") as f:
+            manifests.append(json.load(f))
+    if len(manifests) == 0:
+        raise Exception("No shards found in " + to)
+    shards = manifests[0]['shards']
+    for m in manifests:
+        if m['shards'] != shards or m['count'] != count or m['split'] != split or m['seed'] != manifests[0]['seed']:
+            raise Exception("Shard " + shard_name(m['shard'], m['shards']) + " was synthesized with different parameters")
+    missing_shards = set(range(shards)) - set(m['shard'] for m in manifests)
+    if len(missing_shards) > 0:
+        raise Exception("Missing shards: " + ", ".join(shard_name(s, shards) for s in sorted(missing_shards)))
+
+    # Combine partial metadata and check that every sample is present
+    print("Merging " + str(shards) + " shards...")
+    covered = set()
+    with open(to + "meta.jsonl.tmp", "w") as output:
+        for m in sorted(manifests, key=lambda m: m['shard']):
+            for fname, labels in read_meta(to + "meta." + shard_name(m['shard'], shards) + ".jsonl"):
+                if fname not in covered and is_sample_complete(to, fname):
+                    append_meta(output, fname, labels)
+                    covered.add(fname)
+    missing = [i for i in range(count) if index_path(i) not in covered]
+    if len(missing) > 0:
+        os.remove(to + "meta.jsonl.tmp")
+        raise Exception(str(len(missing)) + " samples are missing, first one is " + index_path(missing[0]))
+    os.replace(to + "meta.jsonl.tmp", to + "meta.jsonl")
+
     # Output
-    with open(to + "meta.json", "w") as outfile:
-        json.dump(output, outfile)
+    write_labels(to, count)
 
 
 
@@ -187,17 +442,37 @@ def synthesize(to, speech_dir, background_dir, rir_real_dir, rir_dir, count = PA
 #
 
 if __name__ == "__main__":
-    print("Synthesizing test set...")
-    synthesize("./dataset/output/vad_test/", 
-           speech_dir="./dataset/output/speech_test/",
-           background_dir="./dataset/output/non_speech/",
-           rir_dir="./dataset/output/rir_synthetic/",
-           rir_real_dir="./dataset/output/rir_real/",
-           count=PARAM_COUNT_TEST)
-    print("Synthesizing train set...")
-    synthesize("./dataset/output/vad_train/", 
-           speech_dir="./dataset/output/speech_train/",
-           background_dir="./dataset/output/non_speech/",
-           rir_dir="./dataset/output/rir_synthetic/",
-           rir_real_dir="./dataset/output/rir_real/",
-           count=PARAM_COUNT)
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--set", choices=["test", "train"], help="process only one set")
+    parser.add_argument("--shard", help="render only a slice of the set, as k/N (k starts from 0)")
+    parser.add_argument("--merge", action="store_true", help="merge metadata of all shards and verify coverage")
+    parser.add_argument("--resume", action="store_true", help="continue an interrupted run")
+    parser.add_argument("--plan", action="store_true", help="only write and describe the plan of samples")
+    args = parser.parse_args()
+    shard = None
+    if args.shard is not None:
+        shard = tuple(int(x) for x in args.shard.split("/"))
+        if len(shard) != 2 or not (0 <= shard[0] < shard[1]):
+            raise Exception("Invalid shard " + args.shard)
+
+    sets = {
+        "test": ("./dataset/output/vad_test/", "./dataset/output/speech_test/", PARAM_COUNT_TEST),
+        "train": ("./dataset/output/vad_train/", "./dataset/output/speech_train/", PARAM_COUNT),
+    }
+    for split in (["test", "train"] if args.set is None else [args.set]):
+        to, speech_dir, count = sets[split]
+        if args.merge:
+            print("Merging " + split + " set...")
+            merge(to, count=count, split=split)
+        else:
+            print("Synthesizing " + split + " set...")
+            synthesize(to, 
+                   speech_dir=speech_dir,
+                   background_dir="./dataset/output/non_speech/",
+                   rir_dir="./dataset/output/rir_synthetic/",
+                   rir_real_dir="./dataset/output/rir_real/",
+                   count=count,
+                   split=split,
+                   shard=shard,
+                   resume=args.resume or PARAM_RESUME,
+                   plan_only=args.plan)
@@ -0,0 +1,87 @@
+import json
+import tarfile
+import torch
+from utils import SAMPLE_RATE, save_audio, encode_audio, tar_add
+from utils_store import write_label_store
+import dataset
+
+LENGTHS = [SAMPLE_RATE * 5 - 700, SAMPLE_RATE * 5, SAMPLE_RATE * 5 + 1100, SAMPLE_RATE * 3]
+
+def make_samples():
+    samples = []
+    for i, length in enumerate(LENGTHS):
+        audio = (torch.rand(length) - 0.5) * 0.5
+        samples.append(('00000000/%08d.wav' % i, audio, [(0.5, length / SAMPLE_RATE)]))
+    return samples
+
+def check_batch(audio, labels):
+    assert audio.shape == (len(LENGTHS), dataset.PARAM_DURATION * SAMPLE_RATE)
+    assert labels.shape == (len(LENGTHS), dataset.PARAM_DURATION * SAMPLE_RATE // dataset.PARAM_TOKEN)
+
+    # Labels end with the audio of shorter clips
+    short = LENGTHS.index(SAMPLE_RATE * 3)
+    assert labels[short, SAMPLE_RATE * 3 // dataset.PARAM_TOKEN:].sum() == 0
+    assert audio[short, SAMPLE_RATE * 3:].abs().sum() == 0
+
+def test_wav_batch_of_different_lengths(tmp_path):
+    path = str(tmp_path) + "/"
+    (tmp_path / "00000000").mkdir()
+    meta = {}
+    for fname, audio, intervals in make_samples():
+        save_audio(path + fname, audio)
+        meta[fname] = intervals
+    with open(path + "meta.json", "w") as f:
+        json.dump(meta, f)
+
+    loader = dataset.create_loader(dataset.VADDataset(path), len(LENGTHS), workers=0, shuffle=False)
+    check_batch(*next(iter(loader)))
+
+def test_shard_batch_of_different_lengths(tmp_path):
+    path = str(tmp_path) + "/"
+    with tarfile.open(path + "00000000.tar", "w") as tar:
+        for fname, audio, intervals in make_samples():
+            key = fname[len("00000000/"):-len(".wav")]
+            tar_add(tar, key + ".wav", encode_audio(audio))
+            tar_add(tar, key + ".json", json.dumps({ 'labels': intervals }).encode())
+
+    loader = dataset.create_loader(dataset.VADShardDataset(path), len(LENGTHS), workers=0)
+    check_batch(*next(iter(loader)))
+
+def test_evaluation_loader_keeps_partial_batch(tmp_path):
+    path = str(tmp_path) + "/"
+    (tmp_path / "00000000").mkdir()
+    meta = {}
+    for fname, audio, intervals in make_samples():
+        save_audio(path + fname, audio)
+        meta[fname] = intervals
+    with open(path + "meta.json", "w") as f:
+        json.dump(meta, f)
+
+    loader = dataset.create_loader(dataset.VADDataset(path), len(LENGTHS) + 1, workers=0, shuffle=False)
+    assert [audio.shape[0] for audio, labels in loader] == [len(LENGTHS)]
+    loader = dataset.create_loader(dataset.VADDataset(path), len(LENGTHS) + 1, workers=0, shuffle=True)
+    assert len(list(loader)) == 0
+
+def test_readers_agree(tmp_path):
+    path = str(tmp_path) + "/"
+    (tmp_path / "00000000").mkdir()
+    samples = make_samples()
+    meta = {}
+    with tarfile.open(path + "00000000.tar", "w") as tar:
+        for fname, audio, intervals in samples:
+            save_audio(path + fname, audio)
+            meta[fname] = intervals
+            key = fname[len("00000000/"):-len(".wav")]
+            tar_add(tar, key + ".wav", encode_audio(audio))
+            tar_add(tar, key + ".json", json.dumps({ 'labels': intervals }).encode())
+    with open(path + "meta.json", "w") as f:
+        json.dump(meta, f)
+
+    from_meta = list(dataset.VADDataset(path))
+    write_label_store(path + "labels/", [fname for fname, _, _ in samples], meta.items())
+    from_store = list(dataset.VADDataset(path))
+    from_shards = list(dataset.VADShardDataset(path))
+    assert len(from_meta) == len(from_store) == len(from_shards) == len(samples)
+    for a, b, c in zip(from_meta, from_store, from_shards):
+        for x, y, z in zip(a, b, c):
+            assert torch.equal(x, y) and torch.equal(x, z)
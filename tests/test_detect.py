@@ -0,0 +1,102 @@
+import os
+import pytest
+import torch
+from utils import SAMPLE_RATE, save_audio
+from utils_store import ScoreStore
+import utils_index
+
+detect = pytest.importorskip("detect")
+
+def make_speech(tmp_path):
+    dir = str(tmp_path / "speech") + "/"
+    os.makedirs(dir + "00000000")
+    generator = torch.Generator().manual_seed(1)
+    for i in range(24):
+        audio = torch.zeros(SAMPLE_RATE * 3)
+        start = (i * 997) % (SAMPLE_RATE * 2)
+        audio[start:start + SAMPLE_RATE // 2 + i * 300] = (torch.rand(SAMPLE_RATE // 2 + i * 300, generator=generator) - 0.5) * (i % 4 + 1) * 0.1
+        save_audio(dir + f'00000000/{i:08d}.wav', audio)
+    return dir
+
+def read_labels(dir):
+    with open(dir + "meta.json", "rb") as f:
+        return f.read()
+
+def test_export_reproduces_detector_output(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils_index, "PARAM_INDEX_PATH", str(tmp_path / "index.sqlite"))
+    monkeypatch.setattr(detect, "PARAM_MODE", "naive")
+    monkeypatch.setattr(detect, "PARAM_WORKERS", 2)
+    monkeypatch.setattr(detect, "PARAM_FILES_PER_TASK", 2) # Results arrive out of order
+    monkeypatch.setattr(detect, "PARAM_META_JSON", True)
+    dir = make_speech(tmp_path)
+
+    detect.run_detector(dir)
+    detected = read_labels(dir)
+    detect.export(dir, detect.PARAM_SPEECH_NAIVE_TRESHOLD, detect.PARAM_SPEECH_SMOOTH)
+    exported = read_labels(dir)
+    assert exported == detected
+    assert b'[[' in detected # Some speech was found
+
+def test_stream_empty_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(detect, "PARAM_MODE", "naive")
+    path = str(tmp_path / "empty.wav")
+    save_audio(path, torch.zeros(0))
+    duration, scores, intervals = detect.detect_stream(path)
+    assert duration == 0 and scores.shape == (0,) and scores.dtype == torch.float32 and intervals == []
+    assert torch.equal(detect.detect_scores(torch.zeros(0)).float(), scores)
+
+def test_short_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(detect, "PARAM_MODE", "naive")
+    path = str(tmp_path / "short.wav")
+    save_audio(path, torch.full((100,), 0.5))
+    duration, scores, intervals = detect.detect_stream(path)
+    assert scores.shape == (0,) and intervals == []
+    assert detect.scores_to_intervals(detect.detect_scores(torch.full((100,), 0.5)), detect.current_treshold(), detect.PARAM_SPEECH_SMOOTH) == []
+
+def test_sweep_and_export_without_scores(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils_index, "PARAM_INDEX_PATH", str(tmp_path / "index.sqlite"))
+    monkeypatch.setattr(detect, "PARAM_MODE", "naive")
+    monkeypatch.setattr(detect, "PARAM_WORKERS", 0)
+    dir = str(tmp_path / "speech") + "/"
+    os.makedirs(dir + "00000000")
+    save_audio(dir + "00000000/00000000.wav", torch.zeros(0))
+    save_audio(dir + "00000000/00000001.wav", torch.full((100,), 0.5))
+    detect.run_detector(dir)
+    assert os.path.getsize(dir + "scores/scores.bin") == 0
+    detect.sweep(dir)
+    detect.export(dir, detect.PARAM_SPEECH_NAIVE_TRESHOLD, detect.PARAM_SPEECH_SMOOTH)
+
+def test_export_other_treshold_equals_detector(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils_index, "PARAM_INDEX_PATH", str(tmp_path / "index.sqlite"))
+    monkeypatch.setattr(detect, "PARAM_MODE", "naive")
+    monkeypatch.setattr(detect, "PARAM_WORKERS", 0)
+    monkeypatch.setattr(detect, "PARAM_META_JSON", True)
+    dir = make_speech(tmp_path)
+    treshold = 0.12 # Above the peaks of quieter files
+    detect.run_detector(dir)
+    detected = read_labels(dir)
+    detect.export(dir, treshold, detect.PARAM_SPEECH_SMOOTH)
+    exported = read_labels(dir)
+    assert exported != detected
+
+    monkeypatch.setattr(detect, "PARAM_SPEECH_NAIVE_TRESHOLD", treshold)
+    detect.run_detector(dir)
+    assert exported == read_labels(dir)
+
+def test_streaming_equals_whole_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils_index, "PARAM_INDEX_PATH", str(tmp_path / "index.sqlite"))
+    monkeypatch.setattr(detect, "PARAM_MODE", "naive")
+    monkeypatch.setattr(detect, "PARAM_WORKERS", 0)
+    monkeypatch.setattr(detect, "PARAM_META_JSON", True)
+    dir = make_speech(tmp_path)
+    detect.run_detector(dir)
+    whole = read_labels(dir)
+    scores = ScoreStore(dir + "scores/")
+    whole_scores = [scores.get(i).clone() for i in range(len(scores))]
+
+    monkeypatch.setattr(detect, "PARAM_STREAM_MIN_DURATION", 0)
+    monkeypatch.setattr(detect, "PARAM_STREAM_BLOCK", 4321) # Not a multiple of a token
+    detect.run_detector(dir)
+    assert read_labels(dir) == whole
+    scores = ScoreStore(dir + "scores/")
+    assert all(torch.equal(scores.get(i), s) for i, s in enumerate(whole_scores))
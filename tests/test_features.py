@@ -0,0 +1,38 @@
+import os
+import pytest
+import torch
+from utils import SAMPLE_RATE, save_audio, load_audio
+import utils_features
+
+@pytest.fixture(autouse=True)
+def workers(monkeypatch):
+    monkeypatch.setattr(utils_features, "PARAM_WORKERS", 0)
+
+def test_empty_directory(tmp_path):
+    source = str(tmp_path / "source") + "/"
+    os.mkdir(source)
+    store = utils_features.build_feature_store(source, [])
+    assert len(store) == 0
+    assert utils_features.open_feature_store(source, []) is not None
+
+def test_zero_length_files(tmp_path):
+    source = str(tmp_path / "source") + "/"
+    os.mkdir(source)
+    files = ["a.wav", "b.wav"]
+    for f in files:
+        save_audio(source + f, torch.zeros(0))
+    store = utils_features.build_feature_store(source, files)
+    assert len(store) == 2
+    for i in range(2):
+        assert store.get(i).shape == (80, 0) and store.lengths[i] == 0
+
+def test_mixed_lengths(tmp_path):
+    source = str(tmp_path / "source") + "/"
+    os.mkdir(source)
+    files = ["a.wav", "b.wav", "c.wav"]
+    for f, length in zip(files, [SAMPLE_RATE, 0, 3000]):
+        save_audio(source + f, (torch.rand(length) - 0.5) * 0.5)
+    store = utils_features.build_feature_store(source, files, 2880)
+    for i, f in enumerate(files):
+        audio = torch.nn.functional.pad(load_audio(source + f), (2880, 0))
+        assert torch.equal(store.get(i), utils_features.log_mel_spectrogram(audio))
@@ -0,0 +1,46 @@
+import os
+import pytest
+import torch
+from utils import SAMPLE_RATE, save_audio, append_record, read_records, index_path
+import utils_index
+import prepare
+
+@pytest.fixture
+def files(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils_index, "PARAM_INDEX_PATH", str(tmp_path / "index.sqlite"))
+    source = str(tmp_path / "source") + "/"
+    os.mkdir(source)
+    generator = torch.Generator().manual_seed(1)
+    for i, duration in enumerate([0.3, 3, 7.5, 12, 26, 5.2]):
+        save_audio(source + f'{i}.wav', (torch.rand(int(duration * SAMPLE_RATE), generator=generator) - 0.5) * 0.5)
+    return sorted(source + f for f in os.listdir(source))
+
+def read_files(to):
+    output = {}
+    for dir in sorted(d for d in os.listdir(to) if os.path.isdir(to + d)):
+        for f in sorted(os.listdir(to + dir)):
+            with open(to + dir + "/" + f, "rb") as data:
+                output[dir + "/" + f] = data.read()
+    return output
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_split_resume(tmp_path, files, monkeypatch, workers):
+    monkeypatch.setattr(prepare, "PARAM_WORKERS", workers)
+    reference = str(tmp_path / "reference") + "/"
+    expected = prepare.split_files(files, reference)
+
+    # A lost checkpoint record and a missing segment of another file
+    to = str(tmp_path / "resumed") + "/"
+    prepare.split_files(files, to)
+    records = list(read_records(to + "checkpoint.jsonl"))
+    with open(to + "checkpoint.jsonl", "w") as f:
+        for record in records[1:]:
+            append_record(f, record)
+    lost = [r for r in records[1:] if r['splits'] > 0][0]
+    os.remove(to + index_path(lost['first']))
+
+    with pytest.raises(Exception):
+        prepare.split_files(files, to)
+    count, duration = prepare.split_files(files, to, resume=True)
+    assert count == expected[0] and duration == pytest.approx(expected[1])
+    assert read_files(to) == read_files(reference)
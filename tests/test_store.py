@@ -0,0 +1,66 @@
+import os
+import numpy as np
+import pytest
+import torch
+from utils import SAMPLE_RATE, save_audio, load_audio
+import utils_index
+import utils_store
+
+@pytest.fixture(autouse=True)
+def index(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils_index, "PARAM_INDEX_PATH", str(tmp_path / "index.sqlite"))
+    monkeypatch.setattr(utils_store, "PARAM_WORKERS", 0)
+
+def make_sources(path, lengths):
+    os.makedirs(path, exist_ok=True)
+    for i, length in enumerate(lengths):
+        save_audio(path + f'{i:08d}.wav', (torch.rand(length) - 0.5) * 0.5)
+    return utils_store.list_source_files(path)
+
+def test_empty_store(tmp_path):
+    source = str(tmp_path / "empty") + "/"
+    files = make_sources(source, [])
+    assert utils_store.build_store(source) == (0, 0)
+    store = utils_store.open_store(source, files)
+    assert store is not None and len(store) == 0
+
+def test_store_matches_sources(tmp_path):
+    source = str(tmp_path / "source") + "/"
+    files = make_sources(source, [SAMPLE_RATE, 1234, SAMPLE_RATE * 2])
+    utils_store.build_store(source)
+    store = utils_store.open_store(source, files)
+    assert store is not None
+    for i, f in enumerate(files):
+        assert torch.equal(store.get(i), load_audio(f))
+
+    # Same names, other lengths
+    make_sources(source, [SAMPLE_RATE, 1000, SAMPLE_RATE * 2])
+    assert utils_store.open_store(source, files) is None
+
+def test_store_of_other_format(tmp_path):
+    source = str(tmp_path / "source") + "/"
+    files = make_sources(source, [SAMPLE_RATE])
+    utils_store.build_store(source)
+    os.remove(utils_store.store_path(source) + "info.json")
+    assert utils_store.open_store(source, files) is None
+
+def test_label_store(tmp_path):
+    files = [f'00000000/{i:08d}.wav' for i in range(50)]
+    generator = np.random.default_rng(1)
+    records = []
+    for fname in files:
+        labels = []
+        end = 0
+        for _ in range(generator.integers(0, 4)):
+            start = end + int(generator.integers(1, 20))
+            end = start + int(generator.integers(0, 30))
+            labels.append((start * utils_store.LABEL_SCALE, end * utils_store.LABEL_SCALE))
+        records.append((fname, labels))
+    order = generator.permutation(len(records))
+    utils_store.write_label_store(str(tmp_path / "labels") + "/", files, [records[i] for i in order])
+
+    store = utils_store.LabelStore(str(tmp_path / "labels") + "/")
+    assert len(store) == len(files) and store.files() == files
+    for i, (fname, labels) in enumerate(records):
+        assert store.get(i) == labels and store.index(fname) == i
+    assert list(store.records()) == records
@@ -0,0 +1,169 @@
+import os
+import sys
+import json
+import subprocess
+import pytest
+import torch
+import numpy as np
+from utils import SAMPLE_RATE, save_audio, load_pcm16, append_meta, read_meta, read_tar_samples, index_path
+import utils_index
+import synthesize
+
+COUNT = 1010 # Two folders
+
+@pytest.fixture
+def sources(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils_index, "PARAM_INDEX_PATH", str(tmp_path / "index.sqlite"))
+    monkeypatch.setattr(synthesize, "PARAM_WORKERS", 0)
+    monkeypatch.setattr(synthesize, "PARAM_DSP_BACKEND", "torch")
+    monkeypatch.setattr(synthesize, "PARAM_CODECS_PROB", 0)
+    monkeypatch.setattr(synthesize, "PARAM_EFFECTS", None)
+    generator = torch.Generator().manual_seed(1)
+    dirs = {}
+    for name, length, count in [("speech", SAMPLE_RATE * 4, 8), ("background", SAMPLE_RATE * 7, 4), ("rir", 2000, 2)]:
+        dirs[name] = str(tmp_path / name) + "/"
+        os.mkdir(dirs[name])
+        for i in range(count):
+            save_audio(dirs[name] + f'{i:08d}.wav', (torch.rand(length + i * 1733, generator=generator) - 0.5) * 0.5) # Lengths differ, so batches mix FFT sizes
+    return dirs
+
+def run(to, sources, count = COUNT, **kwargs):
+    synthesize.synthesize(to, sources['speech'], sources['background'], sources['rir'], sources['rir'], count=count, **kwargs)
+
+def read_files(to):
+    # Every WAV file and meta.json as bytes
+    output = {}
+    for dir in sorted(d for d in os.listdir(to) if os.path.isdir(to + d) and d.isdigit()):
+        for f in sorted(os.listdir(to + dir)):
+            with open(to + dir + "/" + f, "rb") as data:
+                output[dir + "/" + f] = data.read()
+    with open(to + "meta.json", "rb") as data:
+        output["meta.json"] = data.read()
+    return output
+
+def read_output(to):
+    samples = {}
+    for tar in sorted(f for f in os.listdir(to) if f.endswith(".tar")):
+        for key, audio, labels in read_tar_samples(to + tar):
+            samples[tar[:-4] + "/" + key + ".wav"] = (audio, labels)
+    return samples
+
+def test_resume(tmp_path, sources, monkeypatch):
+    monkeypatch.setattr(synthesize, "PARAM_WORKERS", 2)
+    reference = str(tmp_path / "reference") + "/"
+    run(reference, sources, 40)
+
+    # Missing and unfinished files, records of the last samples are lost
+    to = str(tmp_path / "resumed") + "/"
+    run(to, sources, 40)
+    os.remove(to + "00000000/00000005.wav")
+    with open(to + "00000000/00000007.wav", "r+b") as f:
+        f.truncate(100)
+    records = list(read_meta(to + "meta.jsonl"))
+    with open(to + "meta.jsonl", "w") as f:
+        for fname, labels in records[:-10]:
+            append_meta(f, fname, labels)
+
+    with pytest.raises(Exception):
+        run(to, sources, 40)
+    run(to, sources, 40, resume=True)
+    assert read_files(to) == read_files(reference)
+
+def test_tar_resume_from_partial_meta(tmp_path, sources, monkeypatch):
+    monkeypatch.setattr(synthesize, "PARAM_OUTPUT_FORMAT", "tar")
+    reference = str(tmp_path / "reference") + "/"
+    run(reference, sources)
+    expected = read_output(reference)
+    assert len(expected) == COUNT
+
+    # Died while appending records of the first folder, its tar is already in place,
+    # the second folder wasn't renamed yet
+    to = str(tmp_path / "resumed") + "/"
+    run(to, sources)
+    records = list(read_meta(to + "meta.jsonl"))
+    with open(to + "meta.jsonl", "w") as f:
+        for fname, labels in records:
+            if fname.startswith("00000000/") and int(fname[9:17]) < 600:
+                append_meta(f, fname, labels)
+    os.remove(to + "00001000.tar")
+
+    run(to, sources, resume=True)
+    resumed = read_output(to)
+    meta = dict(read_meta(to + "meta.jsonl"))
+    assert len(meta) == COUNT and len(list(read_meta(to + "meta.jsonl"))) == COUNT
+    assert set(resumed.keys()) == set(meta.keys()) == set(expected.keys())
+    for fname, (audio, labels) in expected.items():
+        assert torch.equal(resumed[fname][0], audio)
+        assert resumed[fname][1] == labels == meta[fname]
+
+def test_sample_depends_only_on_its_index(tmp_path, sources):
+    short = str(tmp_path / "short") + "/"
+    long = str(tmp_path / "long") + "/"
+    run(short, sources, 20)
+    run(long, sources, 35)
+    a = read_files(short)
+    b = read_files(long)
+    for i in range(20):
+        fname = index_path(i)
+        assert a[fname] == b[fname]
+
+    # Splits have their own streams
+    counts = { 'speech': 8, 'background': 4, 'rir': 2, 'rir_real': 2 }
+    train = synthesize.plan_samples("train", counts, range(50), progress=False)
+    assert all(np.array_equal(train[k], synthesize.plan_samples("train", counts, range(50), progress=False)[k]) for k in train)
+    assert not np.array_equal(train['seed'], synthesize.plan_samples("test", counts, range(50), progress=False)['seed'])
+
+def test_shards_merge_into_single_run(tmp_path, sources):
+    reference = str(tmp_path / "reference") + "/"
+    run(reference, sources)
+
+    # Second shard first, merge checks that every shard is there
+    to = str(tmp_path / "sharded") + "/"
+    run(to, sources, shard=(1, 2))
+    with pytest.raises(Exception):
+        synthesize.merge(to, count=COUNT)
+    run(to, sources, shard=(0, 2))
+    synthesize.merge(to, count=COUNT)
+    assert read_files(to) == read_files(reference)
+
+    # Shards of another count are rejected
+    with pytest.raises(Exception):
+        synthesize.merge(to, count=COUNT + 1)
+
+@pytest.mark.parametrize("batch_size", [1, 7])
+def test_batch_size_does_not_change_samples(tmp_path, sources, monkeypatch, batch_size):
+    reference = str(tmp_path / "reference") + "/"
+    run(reference, sources, 40)
+    monkeypatch.setattr(synthesize, "PARAM_BATCH_SIZE", batch_size)
+    monkeypatch.setattr(synthesize, "PARAM_PLAN_ORDER", ['rir', 'speech'])
+    to = str(tmp_path / "batched") + "/"
+    run(to, sources, 40)
+    assert read_files(to) == read_files(reference)
+
+def test_meta_json_matches_label_store(tmp_path, sources, monkeypatch):
+    monkeypatch.setattr(synthesize, "PARAM_WORKERS", 2)
+    to = str(tmp_path / "output") + "/"
+    run(to, sources, 40)
+    with open(to + "meta.json", "rb") as f:
+        written = f.read()
+    os.remove(to + "meta.json")
+    subprocess.run([sys.executable, "utils_store.py", "--labels", to], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), check=True)
+    with open(to + "meta.json", "rb") as f:
+        assert f.read() == written
+    assert list(json.loads(written).keys()) == [index_path(i) for i in range(40)]
+
+@pytest.mark.parametrize("audio", ["wav", "flac"])
+def test_tar_output_matches_files(tmp_path, sources, monkeypatch, audio):
+    files = str(tmp_path / "files") + "/"
+    run(files, sources, 40)
+    monkeypatch.setattr(synthesize, "PARAM_OUTPUT_FORMAT", "tar")
+    monkeypatch.setattr(synthesize, "PARAM_OUTPUT_AUDIO", audio)
+    to = str(tmp_path / "tar") + "/"
+    run(to, sources, 40)
+    assert os.listdir(to + "labels") and not os.path.isdir(to + "00000000")
+    samples = read_output(to)
+    meta = json.loads(read_files(files)["meta.json"])
+    assert len(samples) == 40
+    for fname, (sample, labels) in samples.items():
+        assert torch.equal(sample, load_pcm16(files + fname))
+        assert labels == meta[fname]
@@ -1,6 +1,10 @@
 import soundfile as sf
-import librosa
 import torch
+import numpy as np
+import json
+import os
+import io
+import tarfile
 
 SAMPLE_RATE = 16000
 
@@ -17,28 +21,205 @@ def intersect_intervals(interval1, interval2):
         return None
     
 def labels_to_intervals(labels, scale):
-    intervals = []
-    start = None
-
-    for i, value in enumerate(labels):
-        # Check for the start of a new interval
-        if value == 1 and start is None:
-            start = i
-        # Check for the end of the current interval
-        elif value == 0 and start is not None:
-            intervals.append((start * scale, (i - 1) * scale))
-            start = None
+    labels = torch.as_tensor(labels)
 
-    # Handle the case where the array ends with a 1
-    if start is not None:
-        intervals.append((start * scale, (len(labels)) * scale))
+    # Interval edges are where the padded 0/1 sequence changes
+    active = torch.nn.functional.pad((labels == 1).int(), (1, 1))
+    edges = active[1:] - active[:-1]
+    starts = torch.nonzero(edges == 1).squeeze(1).tolist()
+    ends = torch.nonzero(edges == -1).squeeze(1).tolist()
 
+    # Ends point to the last active frame, except for the interval
+    # that lasts until the end of the array
+    intervals = []
+    for start, end in zip(starts, ends):
+        if end == len(labels):
+            intervals.append((start * scale, end * scale))
+        else:
+            intervals.append((start * scale, (end - 1) * scale))
     return intervals
 
 
+def intervals_to_labels(intervals, length, scale):
+    # Inverse of labels_to_intervals: ends are the last active frame, or the
+    # length for an interval that lasts until the end
+    labels = torch.zeros(length, dtype=torch.int32)
+    for start, end in intervals:
+        labels[round(start / scale):round(end / scale) + 1] = 1
+    return labels
+
 def load_audio(pathOrTensor):
+    # Fast path: our own outputs are already 16kHz mono and need no resampling,
+    # this gives exactly what librosa would return
+    try:
+        with sf.SoundFile(pathOrTensor) as f:
+            if f.samplerate == SAMPLE_RATE and f.channels == 1:
+                return torch.from_numpy(f.read(dtype='float32'))
+    except RuntimeError: # Format not supported by soundfile
+        pass
+
+    # Everything else goes through librosa, imported lazily as it is slow to import
+    import librosa
     y, _ = librosa.load(pathOrTensor, sr=SAMPLE_RATE, mono=True) # I have found that torchaudio sometimes can't open some wav files
     return torch.from_numpy(y)
 
+def load_audio_blocks(path, block_size = SAMPLE_RATE * 10):
+    # Reads a file as blocks of about block_size samples for files that don't
+    # fit in memory. Other sample rates are resampled as a stream with soxr, the
+    # resampler librosa uses
+    info = sf.info(path)
+    resampler = None
+    if info.samplerate != SAMPLE_RATE:
+        import soxr
+        resampler = soxr.ResampleStream(info.samplerate, SAMPLE_RATE, 1, dtype='float32', quality='HQ')
+    length = resampled_length(info.frames, info.samplerate)
+    produced = 0
+    for block in sf.blocks(path, blocksize=max(1, block_size * info.samplerate // SAMPLE_RATE), dtype='float32', always_2d=True):
+        block = block.mean(axis=1) # Same downmix as librosa
+        if resampler is not None:
+            block = resampler.resample_chunk(block)[:length - produced]
+        produced += block.shape[0]
+        yield torch.from_numpy(block)
+    if resampler is not None:
+        # librosa fixes the length of the output, padding it with zeros
+        block = resampler.resample_chunk(np.zeros(0, dtype=np.float32), last=True)[:length - produced]
+        block = np.pad(block, (0, length - produced - block.shape[0]))
+        yield torch.from_numpy(block)
+
+def resampled_length(frames, samplerate):
+    # Length of audio after load_audio, without decoding it
+    if samplerate == SAMPLE_RATE:
+        return frames
+    return int(np.ceil(frames * SAMPLE_RATE / samplerate))
+
+def load_pcm16(file):
+    # Our own outputs are 16 bit PCM, read them as is and convert without a
+    # float round trip in libsndfile
+    pcm, sr = sf.read(file, dtype='int16')
+    if sr != SAMPLE_RATE or pcm.ndim != 1:
+        raise Exception("Expected 16kHz mono audio")
+    return torch.from_numpy(pcm).float() / 32768
+
 def save_audio(path, tensor):
-    sf.write(path, tensor.numpy(), SAMPLE_RATE, 'PCM_16') # I have found that torchaudio sometimes also corrupts generated wav files
\ No newline at end of file
+    # Numpy int16 samples are written as they are
+    sf.write(path, tensor.numpy() if torch.is_tensor(tensor) else tensor, SAMPLE_RATE, 'PCM_16') # I have found that torchaudio sometimes also corrupts generated wav files
+
+#
+# Worker context
+#
+
+worker_context = {}
+
+def init_worker_context(context):
+    # Used as a pool initializer: workers receive shared read-only state once
+    # instead of a manager proxy in every task
+    worker_context.clear()
+    worker_context.update(context)
+
+def create_file_table(files):
+    # Paths are packed into a single fixed-width byte array: forked workers share
+    # its pages and lookups never touch per-string refcounts
+    return np.array([f.encode('utf-8') for f in files], dtype=np.bytes_)
+
+def file_table_get(table, index):
+    return table[index].decode('utf-8')
+
+#
+# Metadata
+#
+
+def append_record(file, record):
+    file.write(json.dumps(record) + "\n")
+
+def read_records(path):
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError: # Last line could be torn by a crash
+                continue
+
+def append_meta(file, fname, labels):
+    append_record(file, { 'file': fname, 'labels': labels })
+
+def read_meta(path):
+    for record in read_records(path):
+        yield record['file'], record['labels']
+
+def write_meta_json(path, records):
+    # Same layout as json.dump of a dict, but written record by record
+    with open(path, "w") as f:
+        f.write("{")
+        first = True
+        for fname, labels in records:
+            if not first:
+                f.write(", ")
+            f.write(json.dumps(fname) + ": " + json.dumps(labels))
+            first = False
+        f.write("}")
+
+#
+# Output layout
+#
+
+def index_path(index):
+    dir = f'{(index // 1000) * 1000:08d}'
+    return f'{dir}/{index:08d}.wav'
+
+WAV_HEADER_SIZE = 44 # Header written by soundfile for PCM_16 mono
+
+def is_wav_complete(path, frames = None):
+    if not os.path.isfile(path):
+        return False
+    size = os.path.getsize(path)
+
+    # RIFF size is updated when the file is closed, so torn files don't match it
+    with open(path, "rb") as f:
+        header = f.read(12)
+    if len(header) < 12 or header[0:4] != b'RIFF' or int.from_bytes(header[4:8], 'little') + 8 != size:
+        return False
+    return frames is None or size == WAV_HEADER_SIZE + frames * 2
+
+#
+# Tar shards
+#
+# WebDataset-style: every 1000-sample folder is a single tar where each sample
+# is a pair of members sharing a key, <index>.wav (or .flac) and <index>.json
+#
+
+def shard_path(index):
+    return f'{(index // 1000) * 1000:08d}.tar'
+
+def encode_audio(tensor, format = "wav"):
+    buffer = io.BytesIO()
+    sf.write(buffer, tensor.numpy(), SAMPLE_RATE, 'PCM_16', format='WAV')
+    if format == "wav":
+        return buffer.getvalue()
+
+    # libsndfile quantizes floats differently per format, so other formats
+    # get the exact samples of the WAV file
+    buffer.seek(0)
+    pcm, _ = sf.read(buffer, dtype='int16')
+    buffer = io.BytesIO()
+    sf.write(buffer, pcm, SAMPLE_RATE, 'PCM_16', format=format.upper())
+    return buffer.getvalue()
+
+def tar_add(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+def read_tar_samples(path):
+    # Reads the shard sequentially and yields (key, audio, labels) as pairs complete
+    parts = {}
+    with tarfile.open(path, "r|") as tar:
+        for member in tar:
+            key, ext = member.name.rsplit(".", 1)
+            data = tar.extractfile(member).read()
+            if ext == "json":
+                parts.setdefault(key, {})['labels'] = json.loads(data)['labels']
+            else:
+                parts.setdefault(key, {})['audio'] = load_pcm16(io.BytesIO(data))
+            if len(parts[key]) == 2:
+                sample = parts.pop(key)
+                yield key, sample['audio'], sample['labels']
@@ -0,0 +1,152 @@
+import os
+import json
+import shutil
+from tqdm import tqdm
+import multiprocessing
+import numpy as np
+import torch
+from utils import SAMPLE_RATE, load_audio, worker_context, init_worker_context
+
+#
+# Parameters
+#
+
+PARAM_WORKERS = multiprocessing.cpu_count()
+PARAM_FILES_PER_TASK = 16 # Files computed together by a worker
+
+#
+# Log-mel spectrogram
+#
+# 25ms frames with 10ms hop projected on the 80 mel bands of mel_filters.npz,
+# the window and the filters are created once per device
+#
+
+N_FFT = 400
+HOP = 160
+cache = {}
+
+def get_mel_filters(device = "cpu"):
+    key = ('mel', str(device))
+    if key not in cache:
+        filters = torch.from_numpy(np.load(os.path.join(os.path.dirname(os.path.abspath(__file__)), "mel_filters.npz"), allow_pickle=False)["mel_80"])
+        cache[key] = filters.to(device)
+    return cache[key]
+
+def get_window(device = "cpu"):
+    key = ('window', str(device))
+    if key not in cache:
+        cache[key] = torch.hann_window(N_FFT, device=device)
+    return cache[key]
+
+def log_mel_spectrogram(audio):
+    stft = torch.stft(audio, N_FFT, HOP, window=get_window(audio.device), return_complex=False)
+    magnitudes = torch.sum((stft ** 2), dim=-1)[..., :-1]
+    mel_spec = get_mel_filters(audio.device) @ magnitudes
+    return torch.clamp(mel_spec, min=1e-10).log10()
+
+def log_mel_batch(audios):
+    # Same frames as log_mel_spectrogram of every audio: rows get their own
+    # reflection padding before they are padded with zeros to the same length
+    if len(audios) == 1:
+        return [log_mel_spectrogram(audios[0])]
+    rows = [torch.nn.functional.pad(a.unsqueeze(0), (N_FFT // 2, N_FFT // 2), "reflect")[0] for a in audios]
+    length = max(r.shape[0] for r in rows)
+    batch = torch.stack([torch.nn.functional.pad(r, (0, length - r.shape[0])) for r in rows])
+    stft = torch.stft(batch, N_FFT, HOP, window=get_window(batch.device), center=False, return_complex=False)
+    magnitudes = torch.sum((stft ** 2), dim=-1)
+    log_spec = torch.clamp(get_mel_filters(batch.device) @ magnitudes, min=1e-10).log10()
+    return [log_spec[i, :, :a.shape[0] // HOP] for i, a in enumerate(audios)]
+
+#
+# Feature store
+#
+# Log-mel frames of every file of a directory (features.bin, float32 [frames, 80])
+# with frame offsets (offsets.npy), audio lengths (lengths.npy) and relative paths
+# (files.txt). Audio is prefixed with "padding" zeros before the STFT, as the
+# detector does.
+#
+
+def feature_store_path(source_dir):
+    return source_dir.rstrip("/") + ".features/"
+
+class FeatureStore:
+    def __init__(self, path):
+        self.path = path
+        self.offsets = np.load(path + "offsets.npy")
+        if self.offsets[-1] == 0: # Zero-byte files can't be mapped
+            self.features = np.zeros((0, 80), dtype=np.float32)
+        else:
+            self.features = np.memmap(path + "features.bin", dtype=np.float32, mode='r').reshape(-1, 80)
+        self.lengths = np.load(path + "lengths.npy")
+        with open(path + "info.json", "r") as f:
+            self.padding = json.load(f)['padding']
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+    def __reduce__(self):
+        return (FeatureStore, (self.path,))
+
+    def files(self):
+        with open(self.path + "files.txt", "r") as f:
+            return f.read().splitlines()
+
+    def get(self, index):
+        return torch.from_numpy(np.array(self.features[self.offsets[index]:self.offsets[index + 1]])).T
+
+def compute_features(source_dir, files, padding):
+    audios = [torch.nn.functional.pad(load_audio(source_dir + f), (padding, 0)) for f in files]
+    computed = [a for a in audios if a.shape[0] > 0]
+    specs = iter(log_mel_batch(computed) if len(computed) > 0 else [])
+    return [(a.shape[0] - padding, next(specs) if a.shape[0] > 0 else torch.zeros(80, 0)) for a in audios] # Empty audio has no frames
+
+def compute_features_parallel(files):
+    return compute_features(worker_context['dir'], files, worker_context['padding'])
+
+def build_feature_store(source_dir, files, padding = 0):
+    to = feature_store_path(source_dir)
+    tmp = to.rstrip("/") + ".tmp/"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.mkdir(tmp)
+
+    # Compute in parallel, write sequentially in the order of files
+    batches = [files[i:i + PARAM_FILES_PER_TASK] for i in range(0, len(files), PARAM_FILES_PER_TASK)]
+    offsets = np.zeros(len(files) + 1, dtype=np.int64)
+    lengths = np.zeros(len(files), dtype=np.int64)
+    i = 0
+    with open(tmp + "features.bin", "wb") as output, tqdm(total=len(files)) as progress:
+        def write(results):
+            nonlocal i
+            for length, spec in results:
+                output.write(spec.T.contiguous().numpy().tobytes())
+                offsets[i + 1] = offsets[i] + spec.shape[1]
+                lengths[i] = length
+                i += 1
+            progress.update(len(results))
+        if PARAM_WORKERS == 0:
+            for batch in batches:
+                write(compute_features(source_dir, batch, padding))
+        else:
+            context = { 'dir': source_dir, 'padding': padding }
+            with multiprocessing.Pool(processes=PARAM_WORKERS, initializer=init_worker_context, initargs=(context,)) as pool:
+                for results in pool.imap(compute_features_parallel, batches):
+                    write(results)
+    np.save(tmp + "offsets.npy", offsets)
+    np.save(tmp + "lengths.npy", lengths)
+    with open(tmp + "files.txt", "w") as f:
+        f.write("\n".join(files))
+    with open(tmp + "info.json", "w") as f:
+        json.dump({ 'padding': padding }, f)
+    shutil.rmtree(to, ignore_errors=True)
+    os.rename(tmp, to)
+    return FeatureStore(to)
+
+def open_feature_store(source_dir, files, padding = 0):
+    # Returns None if there is no store or it was built for other files or padding
+    path = feature_store_path(source_dir)
+    if not os.path.isdir(path):
+        return None
+    store = FeatureStore(path)
+    if store.padding != padding or store.files() != files:
+        return None
+    return store
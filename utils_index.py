@@ -0,0 +1,117 @@
+import os
+import fnmatch
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+import multiprocessing
+import soundfile as sf
+from utils import SAMPLE_RATE, load_audio
+
+#
+# Parameters
+#
+
+PARAM_INDEX_PATH = "./dataset/index.sqlite" # Audio info cache shared by prepare.py, synthesize.py and detect.py
+PARAM_SCAN_THREADS = 16 # Directories listed at once
+PARAM_WORKERS = multiprocessing.cpu_count()
+
+#
+# Directory scan
+#
+# Same results as glob(root + "**/" + pattern, recursive=True), but every
+# level of the tree is listed in parallel and every directory only once for
+# all patterns
+#
+
+def scan_dir(path):
+    files = []
+    dirs = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name.startswith("."): # glob skips hidden entries too
+                continue
+            if entry.is_dir():
+                dirs.append(entry.path)
+            else:
+                files.append(entry.path)
+    return files, dirs
+
+def scan_files(root):
+    found = []
+    if not os.path.isdir(root):
+        return found
+    pending = [root]
+    with ThreadPoolExecutor(PARAM_SCAN_THREADS) as executor:
+        while len(pending) > 0:
+            results = list(executor.map(scan_dir, pending))
+            pending = []
+            for files, dirs in results:
+                found.extend(files)
+                pending.extend(dirs)
+    return found
+
+def list_files(root, patterns = ["*.wav"], ignore = None):
+    # Ignored paths are relative to the root
+    found = scan_files(root)
+    ignore = set(ignore) if ignore is not None else set()
+    output = []
+    for pattern in patterns:
+        output.extend(f for f in found if fnmatch.fnmatchcase(os.path.basename(f), pattern) and f[len(root):] not in ignore)
+    return output
+
+#
+# Audio info cache
+#
+# Frame count and sample rate of audio files in sqlite, keyed by absolute path.
+# Rows are reused while the size and modification time of the file are the same.
+#
+
+def read_audio_info(path):
+    try:
+        info = sf.info(path)
+        return info.frames, info.samplerate
+    except RuntimeError: # Format not supported by soundfile
+        return load_audio(path).shape[0], SAMPLE_RATE
+
+def read_stat(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+def open_index(path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, frames INTEGER, samplerate INTEGER, duration REAL)")
+    return db
+
+def audio_info(files, path = None):
+    # Returns (frames, samplerate) of every file, only new and changed files are read
+    if path is None:
+        path = PARAM_INDEX_PATH
+    keys = [os.path.abspath(f) for f in files]
+    with ThreadPoolExecutor(PARAM_SCAN_THREADS) as executor:
+        stats = list(executor.map(read_stat, keys))
+    db = open_index(path)
+    try:
+        cached = {}
+        for i in range(0, len(keys), 500): # Sqlite limits the number of variables
+            chunk = keys[i:i + 500]
+            for row in db.execute("SELECT path, size, mtime, frames, samplerate FROM files WHERE path IN (" + ",".join("?" * len(chunk)) + ")", chunk):
+                cached[row[0]] = row[1:]
+
+        # Read missing
+        missing = [i for i, (k, s) in enumerate(zip(keys, stats)) if k not in cached or cached[k][0:2] != s]
+        if len(missing) > 0:
+            print("Reading audio info of " + str(len(missing)) + " files...")
+            if PARAM_WORKERS == 0:
+                infos = list(tqdm(map(read_audio_info, [keys[i] for i in missing]), total=len(missing)))
+            else:
+                with multiprocessing.Pool(processes=PARAM_WORKERS) as pool:
+                    infos = list(tqdm(pool.imap(read_audio_info, [keys[i] for i in missing], chunksize=64), total=len(missing)))
+            rows = [(keys[i], *stats[i], frames, samplerate, frames / samplerate) for i, (frames, samplerate) in zip(missing, infos)]
+            db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)", rows)
+            db.commit()
+            for row in rows:
+                cached[row[0]] = row[1:5]
+    finally:
+        db.close()
+    return [tuple(cached[k][2:4]) for k in keys]
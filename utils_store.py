@@ -0,0 +1,332 @@
+import os
+import json
+import shutil
+import array
+import argparse
+from functools import partial
+from tqdm import tqdm
+import multiprocessing
+import numpy as np
+import soundfile as sf
+import torch
+from utils import SAMPLE_RATE, load_audio, resampled_length, write_meta_json, create_file_table, file_table_get
+from utils_index import list_files, audio_info
+
+#
+# Parameters
+#
+
+PARAM_WORKERS = multiprocessing.cpu_count()
+
+#
+# Source store
+#
+# All files of a source directory decoded into a single int16 blob
+# (audio.bin) with sample offsets (offsets.npy), relative paths (files.txt)
+# in the same order as the sorted directory listing and the format of the
+# samples (info.json).
+#
+
+STORE_INFO = { 'samplerate': SAMPLE_RATE, 'dtype': 'int16' }
+
+def store_path(source_dir):
+    return source_dir.rstrip("/") + ".store/"
+
+def list_source_files(source_dir):
+    # Sorted, so that sample seeds pick the same files on every machine
+    return sorted(list_files(source_dir))
+
+class AudioStore:
+    def __init__(self, path):
+        self.path = path
+        self.offsets = np.load(path + "offsets.npy")
+        if self.offsets[-1] == 0: # Zero-byte files can't be mapped
+            self.audio = np.zeros(0, dtype=np.int16)
+        else:
+            self.audio = np.memmap(path + "audio.bin", dtype=np.int16, mode='r')
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+    def __reduce__(self):
+        # Reopen the mapping in the worker instead of pickling the audio
+        return (AudioStore, (self.path,))
+
+    def files(self):
+        with open(self.path + "files.txt", "r") as f:
+            return f.read().splitlines()
+
+    def get(self, index):
+        pcm = self.audio[self.offsets[index]:self.offsets[index + 1]]
+        return torch.from_numpy(pcm.astype(np.float32) / 32768)
+
+    def window(self, index):
+        start = int(self.offsets[index])
+        return AudioWindow(lambda offset, frames: torch.from_numpy(self.audio[start + offset:start + offset + frames].astype(np.float32) / 32768), int(self.offsets[index + 1]) - start)
+
+#
+# Source files
+#
+# Sources without a store. Frame counts come from the audio info index and
+# are -1 for files that need resampling, those are always loaded whole.
+#
+
+class SourceFiles:
+    def __init__(self, files, frames = None):
+        self.table = create_file_table(files)
+        self.frames = frames
+
+    def __len__(self):
+        return self.table.shape[0]
+
+    def get(self, index):
+        return load_audio(file_table_get(self.table, index))
+
+    def window(self, index):
+        if self.frames is None or self.frames[index] < 0:
+            return self.get(index)
+        return AudioWindow(partial(read_window, file_table_get(self.table, index)), int(self.frames[index]))
+
+def source_frames(files):
+    return np.array([frames if samplerate == SAMPLE_RATE else -1 for frames, samplerate in audio_info(files)], dtype=np.int64)
+
+class AudioWindow:
+    # Audio of a known length that is decoded only in the slices taken from it,
+    # for code that picks offsets from the length (select_random_segment)
+    def __init__(self, read, length):
+        self.read = read
+        self.shape = (length,)
+
+    def __getitem__(self, s):
+        start, stop, _ = s.indices(self.shape[0])
+        return self.read(start, max(stop - start, 0))
+
+def read_window(path, start, frames):
+    # Same samples as load_audio(path)[start:start + frames] of a 16kHz file
+    with sf.SoundFile(path) as f:
+        if f.channels == 1:
+            f.seek(start)
+            return torch.from_numpy(f.read(frames, dtype='float32'))
+    return load_audio(path)[start:start + frames]
+
+def read_pcm16(path):
+    info = sf.info(path)
+    if info.samplerate == SAMPLE_RATE and info.channels == 1:
+        pcm, _ = sf.read(path, dtype='int16')
+        return pcm
+    audio = load_audio(path)
+    return (audio * 32768).round().clamp(-32768, 32767).to(torch.int16).numpy()
+
+def build_store(source_dir):
+    to = store_path(source_dir)
+    if os.path.isdir(to):
+        raise Exception("Directory " + to + " already exist!")
+    tmp = to.rstrip("/") + ".tmp/"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.mkdir(tmp)
+
+    # Decode in parallel, write sequentially in listing order
+    files = list_source_files(source_dir)
+    offsets = np.zeros(len(files) + 1, dtype=np.int64)
+    with open(tmp + "audio.bin", "wb") as output:
+        if PARAM_WORKERS == 0:
+            for i, pcm in enumerate(tqdm(map(read_pcm16, files), total=len(files))):
+                output.write(pcm.tobytes())
+                offsets[i + 1] = offsets[i] + pcm.shape[0]
+        else:
+            with multiprocessing.Pool(processes=PARAM_WORKERS) as pool:
+                for i, pcm in enumerate(tqdm(pool.imap(read_pcm16, files, chunksize=64), total=len(files))):
+                    output.write(pcm.tobytes())
+                    offsets[i + 1] = offsets[i] + pcm.shape[0]
+    np.save(tmp + "offsets.npy", offsets)
+    with open(tmp + "files.txt", "w") as f:
+        f.write("\n".join(os.path.relpath(x, source_dir) for x in files))
+    with open(tmp + "info.json", "w") as f:
+        json.dump(STORE_INFO, f)
+    os.rename(tmp, to)
+
+    return len(files), int(offsets[-1]) / SAMPLE_RATE
+
+def open_store(source_dir, files):
+    # Returns None if there is no store or it doesn't match the directory listing
+    path = store_path(source_dir)
+    if not os.path.isdir(path):
+        return None
+    if not is_store_valid(path, source_dir, files):
+        print("Store " + path + " is outdated, rebuild it to use it")
+        return None
+    return AudioStore(path)
+
+def is_store_valid(path, source_dir, files):
+    # Same format, same names and the same decoded length of every file
+    if not os.path.isfile(path + "info.json"):
+        return False
+    with open(path + "info.json", "r") as f:
+        if json.load(f) != STORE_INFO:
+            return False
+    with open(path + "files.txt", "r") as f:
+        if f.read().splitlines() != [os.path.relpath(x, source_dir) for x in files]:
+            return False
+    offsets = np.load(path + "offsets.npy")
+    if os.path.getsize(path + "audio.bin") != offsets[-1] * np.dtype(np.int16).itemsize:
+        return False
+    lengths = np.array([resampled_length(frames, samplerate) for frames, samplerate in audio_info(files)], dtype=np.int64)
+    return np.array_equal(np.diff(offsets), lengths)
+
+#
+# Label store
+#
+# Labels of all samples as 20ms frame pairs (intervals.npy, int32 [M, 2]) with
+# per-sample offsets (offsets.npy) and sample names (files.txt). Sample i is
+# the i-th name, so lookups by index need no parsing.
+#
+
+LABEL_SCALE = 0.02 # 20ms tokens
+
+class LabelStore:
+    def __init__(self, path):
+        self.path = path
+        self.intervals = np.load(path + "intervals.npy", mmap_mode='r')
+        self.offsets = np.load(path + "offsets.npy", mmap_mode='r')
+        self.names = None
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+    def __reduce__(self):
+        return (LabelStore, (self.path,))
+
+    def files(self):
+        with open(self.path + "files.txt", "r") as f:
+            return f.read().splitlines()
+
+    def frames(self, index):
+        return self.intervals[self.offsets[index]:self.offsets[index + 1]]
+
+    def get(self, index):
+        # Same values as labels_to_intervals(labels, LABEL_SCALE)
+        return [(int(start) * LABEL_SCALE, int(end) * LABEL_SCALE) for start, end in self.frames(index)]
+
+    def index(self, fname):
+        if self.names is None:
+            self.names = { f: i for i, f in enumerate(self.files()) }
+        return self.names[fname]
+
+    def records(self):
+        for i, fname in enumerate(self.files()):
+            yield fname, self.get(i)
+
+def write_label_store(path, files, records):
+    # Records can come in any order, they are placed by the position of their
+    # name in files. Intervals are collected in compact arrays instead of lists
+    positions = { f: i for i, f in enumerate(files) }
+    owners = array.array('q')
+    frames = array.array('i')
+    for fname, labels in records:
+        if fname not in positions:
+            raise Exception("Unknown sample " + fname)
+        for start, end in labels:
+            owners.append(positions[fname])
+            frames.append(round(start / LABEL_SCALE))
+            frames.append(round(end / LABEL_SCALE))
+    owners = np.frombuffer(owners, dtype=np.int64)
+    order = np.argsort(owners, kind='stable')
+    offsets = np.zeros(len(files) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(owners, minlength=len(files)))
+
+    # Write
+    tmp = path.rstrip("/") + ".tmp/"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.mkdir(tmp)
+    np.save(tmp + "intervals.npy", np.frombuffer(frames, dtype=np.int32).reshape(-1, 2)[order])
+    np.save(tmp + "offsets.npy", offsets)
+    with open(tmp + "files.txt", "w") as f:
+        f.write("\n".join(files))
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp, path)
+
+#
+# Score store
+#
+# Raw detector scores of every 20ms token (scores.bin, float32) with the range
+# of every file in it (ranges.npy, int64 [N, 2]), durations (durations.npy),
+# relative paths (files.txt) and the detector settings (info.json). Files are
+# appended in the order they are detected.
+#
+
+class ScoreStore:
+    def __init__(self, path):
+        self.path = path
+        self.ranges = np.load(path + "ranges.npy")
+        if self.ranges[:, 1].max(initial=0) == 0: # Zero-byte files can't be mapped
+            self.scores = np.zeros(0, dtype=np.float32)
+        else:
+            self.scores = np.memmap(path + "scores.bin", dtype=np.float32, mode='r')
+        self.durations = np.load(path + "durations.npy")
+        with open(path + "info.json", "r") as f:
+            self.info = json.load(f)
+
+    def __len__(self):
+        return self.ranges.shape[0]
+
+    def __reduce__(self):
+        return (ScoreStore, (self.path,))
+
+    def files(self):
+        with open(self.path + "files.txt", "r") as f:
+            return f.read().splitlines()
+
+    def get(self, index):
+        start, end = self.ranges[index]
+        return torch.from_numpy(np.array(self.scores[start:end]))
+
+class ScoreStoreWriter:
+    def __init__(self, path, files, info):
+        self.path = path
+        self.files = files
+        self.info = info
+        self.positions = { f: i for i, f in enumerate(files) }
+        self.ranges = np.zeros((len(files), 2), dtype=np.int64)
+        self.durations = np.zeros(len(files), dtype=np.float64)
+        self.written = 0
+        self.tmp = path.rstrip("/") + ".tmp/"
+        shutil.rmtree(self.tmp, ignore_errors=True)
+        os.mkdir(self.tmp)
+        self.output = open(self.tmp + "scores.bin", "wb")
+
+    def append(self, fname, duration, scores):
+        i = self.positions[fname]
+        scores = scores.numpy().astype(np.float32)
+        self.output.write(scores.tobytes())
+        self.ranges[i] = (self.written, self.written + scores.shape[0])
+        self.durations[i] = duration
+        self.written += scores.shape[0]
+
+    def close(self):
+        self.output.close()
+        np.save(self.tmp + "ranges.npy", self.ranges)
+        np.save(self.tmp + "durations.npy", self.durations)
+        with open(self.tmp + "files.txt", "w") as f:
+            f.write("\n".join(self.files))
+        with open(self.tmp + "info.json", "w") as f:
+            json.dump(self.info, f)
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.rename(self.tmp, self.path)
+
+#
+# Main
+#
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--labels", help="convert the label store of a synthesized or detected directory to meta.json")
+    args = parser.parse_args()
+    if args.labels is not None:
+        d = args.labels.rstrip("/") + "/"
+        print("Writing " + d + "meta.json...")
+        write_meta_json(d + "meta.json", LabelStore(d + "labels/").records())
+    else:
+        for d in ["./dataset/output/speech_train/", "./dataset/output/speech_test/", "./dataset/output/non_speech/", "./dataset/output/rir_real/", "./dataset/output/rir_synthetic/"]:
+            print("Building store for " + d + "...")
+            count, duration = build_store(d)
+            print("Files: ", count, " duration: ", duration)
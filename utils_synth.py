@@ -1,67 +1,81 @@
 import random
+import math
 from utils import SAMPLE_RATE
 import torch
 import torchaudio
 import torchaudio.functional as F
 
-#
-# Applying RIR
-#
-
-def reverbrate(waveforms, rir, preprocess = False):
-    assert len(waveforms.shape) == 1 # Only single dimension is allowed
-    assert len(rir.shape) == 1 # Only single dimension is allowed
-
-    # Find start of a RIR and cut the begining
-    if preprocess:
-        # Find peak index
-        _, direct_index = rir.abs().max(axis=0, keepdim=True)
-
-        # Cut from after peak
-        rir = rir[direct_index:]
-
-    # Source length
-    source_len = waveforms.shape[0]
-
-    # Normalize remaining
-    rir = rir / torch.norm(rir, p=2) # Mean square
-
-    # NOTE: THIS ALL NOT NEEDED for fftconvolve
-    # Flip for convolution (we are adding previous values (aka "echo") for each point
-    # rir = torch.flip(rir,[0])
-
-    # Pad with zeros to match output time
-    # waveforms = torch.cat((torch.zeros(rir.shape[0]-1,dtype=waveforms.dtype), waveforms), 0)
-
-    # Calculate convolution
-    waveforms = waveforms.unsqueeze(0).unsqueeze(0)
-    rir = rir.unsqueeze(0).unsqueeze(0)
-    # waveforms = torch.nn.functional.conv1d(waveforms, rir)
-    waveforms = torchaudio.functional.fftconvolve(waveforms, rir)
-    waveforms = waveforms.squeeze(dim=0).squeeze(dim=0)
-    waveforms = waveforms[0:source_len]
-
-    return waveforms
-
 #
 # Naive sound detector
 #
 
 def smooth_sound_detector(detections, max_duration):
     assert len(detections.shape) == 1 # Only single dimension is allowed
-    output = torch.zeros(detections.shape[0])
-    counter = 0
-    for i in range(0, detections.shape[0]):
-        output[i] = detections[i]
-        if detections[i] == 0:
-            counter = counter + 1
-        else:
-            if (counter > 0) and (counter <= max_duration):
-                for j in range(i-counter, i):
-                    output[j] = 1                    
-            counter = 0
+    return smooth_sound_detector_batch(detections.unsqueeze(0), max_duration)[0]
+
+def smooth_sound_detector_batch(detections, max_duration):
+    assert len(detections.shape) == 2 # Only [B, T] is allowed
+    length = detections.shape[1]
+    positions = torch.arange(length, device=detections.device).expand(detections.shape)
+    voiced = detections != 0
+
+    # Nearest voiced frame after and before every frame
+    next_voiced = torch.where(voiced, positions, length)
+    next_voiced = torch.flip(torch.cummin(torch.flip(next_voiced, [1]), dim=1).values, [1])
+    prev_voiced = torch.where(voiced, positions, -1)
+    prev_voiced = torch.cummax(prev_voiced, dim=1).values
+
+    # Fill short gaps that are followed by voice (including the leading one)
+    gap = next_voiced - prev_voiced - 1
+    fill = (~voiced) & (next_voiced < length) & (gap <= max_duration)
+    output = detections.float().clone()
+    output[fill] = 1
     return output
 
+class StreamingSmoother:
+    # Same as smooth_sound_detector followed by labels_to_intervals, but labels
+    # come in chunks and intervals are returned as soon as they can't grow
+    def __init__(self, max_duration, scale):
+        self.max_duration = max_duration
+        self.scale = scale
+        self.length = 0 # Labels received so far
+        self.start = None # Start of the open interval
+        self.last = -1 # Last voiced label
+
+    def push(self, labels):
+        output = []
+
+        # Voiced runs of the chunk
+        active = torch.nn.functional.pad((torch.as_tensor(labels) != 0).int(), (1, 1))
+        edges = active[1:] - active[:-1]
+        starts = (torch.nonzero(edges == 1).squeeze(1) + self.length).tolist()
+        ends = (torch.nonzero(edges == -1).squeeze(1) + self.length - 1).tolist()
+        for start, end in zip(starts, ends):
+            if self.start is not None and start - self.last - 1 > self.max_duration:
+                output.append((self.start * self.scale, self.last * self.scale))
+                self.start = None
+            if self.start is None:
+                # Leading gap is filled too
+                self.start = 0 if self.last < 0 and start <= self.max_duration else start
+            self.last = end
+        self.length += len(labels)
+
+        # Interval is closed when the gap after it is too long to be filled
+        if self.start is not None and self.length - self.last - 1 > self.max_duration:
+            output.append((self.start * self.scale, self.last * self.scale))
+            self.start = None
+        return output
+
+    def close(self):
+        if self.start is None:
+            return []
+
+        # Interval that lasts until the end ends at the length
+        end = self.length if self.last == self.length - 1 else self.last
+        output = [(self.start * self.scale, end * self.scale)]
+        self.start = None
+        return output
+
 def sound_detector(waveform, frame_size, treshold):
     waveform = waveform.unfold(-1, frame_size, frame_size)
     return (waveform.abs().max(dim=-1).values > treshold).float()
@@ -70,7 +84,7 @@ def sound_detector(waveform, frame_size, treshold):
 # Alligning audio segment to merge into another one
 #
 
-def select_random_segment(source, length):
+def select_random_segment(source, length, rng = random):
     output = torch.zeros(length)
 
     # If source is equal to the target
@@ -78,10 +92,10 @@ def select_random_segment(source, length):
     source_offset = 0
     l = length
     if source.shape[0] < length:  # If source is smaller than needed
-        to_offset = random.randint(0, length - source.shape[0])
+        to_offset = rng.randint(0, length - source.shape[0])
         l = source.shape[0]
     elif source.shape[0] > length: # IF source is bigger than needed
-        source_offset = random.randint(0, source.shape[0] - length)
+        source_offset = rng.randint(0, source.shape[0] - length)
 
     # Apply
     output[to_offset:to_offset+l] = output[to_offset:to_offset+l] + source[source_offset:source_offset+l]
@@ -92,18 +106,18 @@ def select_random_segment(source, length):
 # Mondifying audio
 #
 
-def add_audio_chunk(waveforms, labels, source, speech):
+def add_audio_chunk(waveforms, labels, source, speech, rng = random):
         
     # Calculate offsets
     to_offset = 0
     source_offset = 0
     l = source.shape[0]
     if source.shape[0] < waveforms.shape[0]:
-        to_offset = random.randint(0, waveforms.shape[0] - source.shape[0])
+        to_offset = rng.randint(0, waveforms.shape[0] - source.shape[0])
         source_offset = 0
         l = source.shape[0]
     elif source.shape[0] > waveforms.shape[0]:
-        source_offset = random.randint(0, source.shape[0] - waveforms.shape[0])
+        source_offset = rng.randint(0, source.shape[0] - waveforms.shape[0])
         to_offset = 0
         l = waveforms.shape[0]
 
@@ -118,17 +132,18 @@ def add_audio_chunk(waveforms, labels, source, speech):
         if ll > 0:
             labels[ls : ls + ll] = speech[ss : ss + ll]
 
-def add_audio_noise(waveforms, noise, snr):
-    noise = select_random_segment(noise, waveforms.shape[0])
-    noise = noise.unsqueeze(0)
-    waveforms = waveforms.unsqueeze(0)
-    res = F.add_noise(waveforms, noise, torch.tensor([snr]))[0]
-    # Sometimes it returns NaN - ignore noise then
-    if torch.isnan(res).any():
-        return waveforms[0]
-    else:
-        return res
-    
+#
+# ffmpeg effects
+#
+
+def ffmpeg_effector(**args):
+    # torchaudio.io needs torchaudio built with ffmpeg, it is imported only when
+    # used, so that the torch backend works without it
+    from torchaudio.io import AudioEffector, CodecConfig
+    if 'codec_config' in args:
+        args['codec_config'] = CodecConfig(**args['codec_config'])
+    return AudioEffector(**args)
+
 #
 # Synthesize sample
 #
@@ -149,63 +164,243 @@ def synthesize_sample(duration,
                       clean_tempo = None,
 
                       # RIR
-                      rir = None):
-    waveforms = torch.zeros(SAMPLE_RATE * duration)
-    labels = torch.zeros(SAMPLE_RATE * duration // 320)
+                      rir = None,
+
+                      # Random source for offsets
+                      rng = random,
+
+                      # Filter string applied after effector
+                      effect = None,
+
+                      # "ffmpeg" or "torch" for tempo and filters
+                      backend = "ffmpeg"):
+    waveforms, labels = synthesize_batch(duration, [{
+        'effector': effector,
+        'effect': effect,
+        'background': background,
+        'background_snr': background_snr,
+        'clean': clean,
+        'clean_treshold': clean_treshold,
+        'clean_smooth': clean_smooth,
+        'clean_tempo': clean_tempo,
+        'rir': rir,
+        'rng': rng
+    }], backend)
+    return waveforms[0], labels[0]
+
+#
+# Batched synthesis
+#
+
+def pad_stack(tensors):
+    output = torch.zeros(len(tensors), max(t.shape[0] for t in tensors))
+    for i, t in enumerate(tensors):
+        output[i, 0:t.shape[0]] = t
+    return output
+
+def bucket_rows(lengths, keys, bucket):
+    # Groups rows by key and by length rounded up to the bucket. FFT sizes then depend
+    # only on the row itself, so a row gives the same result in any batch.
+    groups = {}
+    for i, (length, key) in enumerate(zip(lengths, keys)):
+        groups.setdefault((key, (length + bucket - 1) // bucket), []).append(i)
+    return groups
+
+def reverbrate_batch(waveforms, rirs, bucket = SAMPLE_RATE):
+    # Zero padding of both sides doesn't change the first len(waveform) outputs
+    rirs = [rir / torch.norm(rir, p=2) for rir in rirs]
+    rir_buckets = [(rir.shape[0] + bucket - 1) // bucket for rir in rirs]
+    output = [None] * len(waveforms)
+    for (rb, wb), rows in bucket_rows([w.shape[0] for w in waveforms], rir_buckets, bucket).items():
+        w = torch.zeros(len(rows), wb * bucket)
+        r = torch.zeros(len(rows), rb * bucket)
+        for k, i in enumerate(rows):
+            w[k, 0:waveforms[i].shape[0]] = waveforms[i]
+            r[k, 0:rirs[i].shape[0]] = rirs[i]
+        result = torchaudio.functional.fftconvolve(w, r)
+        for k, i in enumerate(rows):
+            output[i] = result[k, 0:waveforms[i].shape[0]]
+    return output
+
+def synthesize_batch(duration, recipes, backend = "ffmpeg"):
+    # Recipes are dicts with all keyword arguments of synthesize_sample, the
+    # result is the same as rendering them one by one
+    waveforms = torch.zeros(len(recipes), SAMPLE_RATE * duration)
+    labels = torch.zeros(len(recipes), SAMPLE_RATE * duration // 320)
+    voiced = [i for i, r in enumerate(recipes) if r['clean'] is not None]
 
     # Add clean sound
-    if clean is not None:
+    if len(voiced) > 0:
 
         # Speed up or slow down
-        if clean_tempo is not None:
-            clean = torchaudio.io.AudioEffector(effect=f'atempo={clean_tempo}').apply(clean.unsqueeze(0).T, SAMPLE_RATE).T[0]
-
-        # Detect voice
-        detected_voice = sound_detector(clean, 320, clean_treshold)
-        detected_voice = smooth_sound_detector(detected_voice, clean_smooth)
+        clean = [recipes[i]['clean'] for i in voiced]
+        stretched = [j for j, i in enumerate(voiced) if recipes[i]['clean_tempo'] is not None]
+        if backend == "torch" and len(stretched) > 0:
+            result = time_stretch_batch([clean[j] for j in stretched], [recipes[voiced[j]]['clean_tempo'] for j in stretched])
+            for k, j in enumerate(stretched):
+                # AudioEffector pads shorter output with silence up to the input length
+                clean[j] = torch.nn.functional.pad(result[k], (0, max(0, clean[j].shape[0] - result[k].shape[0])))
+        else:
+            for j in stretched:
+                tempo = recipes[voiced[j]]['clean_tempo']
+                effector = ffmpeg_effector(effect=f'atempo={tempo}')
+                clean[j] = effector.apply(clean[j].unsqueeze(0).T, SAMPLE_RATE).T[0]
+        lengths = [c.shape[0] for c in clean]
+        padded = pad_stack(clean)
+
+        # Detect voice, frames past the end of a row are never voiced
+        treshold = torch.tensor([recipes[i]['clean_treshold'] for i in voiced]).unsqueeze(1)
+        detected_voice = sound_detector(padded, 320, treshold)
+        detected_voice[torch.arange(detected_voice.shape[1]) >= (torch.tensor(lengths) // 320).unsqueeze(1)] = 0
+        smooth = torch.tensor([recipes[i]['clean_smooth'] for i in voiced]).unsqueeze(1)
+        detected_voice = smooth_sound_detector_batch(detected_voice, smooth)
 
         # Reverbrate. This is a environment feature and we
         # apply it before effects that would simulate voice
         # transmission
-        if rir is not None:
-            clean = reverbrate(clean, rir)
+        reverbed = [j for j, i in enumerate(voiced) if recipes[i]['rir'] is not None]
+        if len(reverbed) > 0:
+            result = reverbrate_batch([clean[j] for j in reverbed], [recipes[voiced[j]]['rir'] for j in reverbed])
+            for k, j in enumerate(reverbed):
+                clean[j] = result[k]
+
+        # Add audio chunks
+        for j, i in enumerate(voiced):
+            add_audio_chunk(waveforms[i], labels[i], clean[j], detected_voice[j, 0:lengths[j] // 320], recipes[i]['rng'])
+
+        # Apply background noise with per-row SNR
+        noisy = [i for i in voiced if recipes[i]['background'] is not None]
+        if len(noisy) > 0:
+            noise = torch.stack([select_random_segment(recipes[i]['background'], waveforms.shape[1], recipes[i]['rng']) for i in noisy])
+            snr = torch.tensor([recipes[i]['background_snr'] for i in noisy])
+            res = F.add_noise(waveforms[noisy], noise, snr)
+            # Sometimes it returns NaN - ignore noise then
+            valid = ~torch.isnan(res).any(dim=1, keepdim=True)
+            waveforms[noisy] = torch.where(valid, res, waveforms[noisy])
+
+    # No clean sound: add background as is
+    for i, r in enumerate(recipes):
+        if r['clean'] is None and r['background'] is not None:
+            add_audio_chunk(waveforms[i], labels[i], r['background'], None, r['rng'])
+
+    # Apply filters, before the effector like AudioEffector does with its own effect
+    output = list(waveforms)
+    filtered = [i for i in voiced if recipes[i]['effect'] is not None]
+    if backend == "torch" and len(filtered) > 0:
+        result = filter_batch([output[i] for i in filtered], [recipes[i]['effect'] for i in filtered])
+        for k, i in enumerate(filtered):
+            output[i] = result[k]
+    else:
+        for i in filtered:
+            effect = recipes[i]['effect']
+            effector = ffmpeg_effector(effect=effect)
+            output[i] = effector.apply(output[i].unsqueeze(0).T, SAMPLE_RATE).T[0]
 
-        # Add audio chunk
-        add_audio_chunk(waveforms, labels, clean, detected_voice)
+    # Apply effector after everything to simluate everything. Codecs can change
+    # the length, so rows are returned as a list
+    for i in voiced:
+        if recipes[i]['effector'] is not None:
+            output[i] = recipes[i]['effector'].apply(output[i].unsqueeze(0).T, SAMPLE_RATE).T[0]
 
-        # Apply background noise
-        if background is not None:
-            waveforms = add_audio_noise(waveforms, background, background_snr)
+    # Return result
+    return output, labels
 
-        # Apply effector after everything to simluate everything
-        if effector is not None:
-            waveforms = effector.apply(waveforms.unsqueeze(0).T, SAMPLE_RATE).T[0]
+#
+# In-process DSP: alternatives to ffmpeg for tempo and filters
+#
 
-    else:
-        # No clean sound: add background as is
-        if background is not None:
-            add_audio_chunk(waveforms, labels, background, None)
+def time_stretch_batch(waveforms, tempos, n_fft = 512, hop = 128, bucket = SAMPLE_RATE):
+    # Phase vocoder, rows with the same tempo are stretched together
+    window = torch.hann_window(n_fft)
+    phase_advance = torch.linspace(0, math.pi * hop, n_fft // 2 + 1).unsqueeze(1)
+    output = [None] * len(waveforms)
+    for (tempo, b), rows in bucket_rows([w.shape[0] for w in waveforms], tempos, bucket).items():
+        padded = torch.zeros(len(rows), b * bucket)
+        for k, i in enumerate(rows):
+            padded[k, 0:waveforms[i].shape[0]] = waveforms[i]
+        spec = torch.stft(padded, n_fft, hop, window=window, return_complex=True)
+        spec = F.phase_vocoder(spec, tempo, phase_advance)
+        result = torch.istft(spec, n_fft, hop, window=window, length=round(b * bucket / tempo))
+        for k, i in enumerate(rows):
+            output[i] = result[k, 0:round(waveforms[i].shape[0] / tempo)]
+    return output
 
-    # Return result
-    return waveforms, labels
+FILTER_DEFAULTS = { # Frequency and Q, same as ffmpeg
+    'lowpass': (500, 0.707),
+    'highpass': (3000, 0.707),
+    'bandpass': (3000, 0.5)
+}
+
+def filter_coefficients(effect):
+    # Biquad coefficients of ffmpeg's lowpass, highpass and bandpass filters
+    name, _, args = effect.partition('=')
+    if name not in FILTER_DEFAULTS:
+        raise Exception("Filter " + name + " is not supported by torch backend")
+    options = dict(o.split('=', 1) for o in args.split(':') if '=' in o)
+    frequency = float(options.get('frequency', options.get('f', FILTER_DEFAULTS[name][0])))
+    q = float(options.get('width', options.get('w', FILTER_DEFAULTS[name][1])))
+    poles = int(options.get('poles', options.get('p', 2)))
+    w0 = 2 * math.pi * frequency / SAMPLE_RATE
+
+    # Single pole
+    if poles == 1 and name != 'bandpass':
+        a1 = -math.exp(-w0)
+        if name == 'lowpass':
+            return [1 + a1, 0, 0], [1, a1, 0]
+        return [(1 - a1) / 2, -(1 - a1) / 2, 0], [1, a1, 0]
+
+    # Two poles
+    alpha = math.sin(w0) / (2 * q)
+    cos = math.cos(w0)
+    if name == 'lowpass':
+        b = [(1 - cos) / 2, 1 - cos, (1 - cos) / 2]
+    elif name == 'highpass':
+        b = [(1 + cos) / 2, -(1 + cos), (1 + cos) / 2]
+    else:
+        b = [alpha, 0, -alpha]
+    a = [1 + alpha, -2 * cos, 1 - alpha]
+    return [x / a[0] for x in b], [x / a[0] for x in a]
+
+def filter_batch(waveforms, effects):
+    # Each row has its own chain of filters, every stage is one lfilter call
+    output = list(waveforms)
+    chains = [e.split(',') for e in effects]
+    for stage in range(max(len(c) for c in chains)):
+        rows = [i for i, c in enumerate(chains) if stage < len(c)]
+        coefficients = [filter_coefficients(chains[i][stage]) for i in rows]
+        b = torch.tensor([c[0] for c in coefficients])
+        a = torch.tensor([c[1] for c in coefficients])
+        result = F.lfilter(pad_stack([output[i] for i in rows]), a, b, clamp=False, batching=True)
+        for k, i in enumerate(rows):
+            output[i] = result[k, 0:output[i].shape[0]]
+    return output
 
 #
 # Effect resolving
 #
 
-def resolve(effectOrFunction):
+def resolve(effectOrFunction, rng = random):
     if isinstance(effectOrFunction, str):
         return effectOrFunction
     elif effectOrFunction is None:
         return None
     else:
-        return resolve(effectOrFunction())
+        return resolve(effectOrFunction(rng), rng)
 
 def one_of(*args):
-    return lambda:resolve(random.choice(list(args)))
+    return lambda rng:resolve(rng.choice(list(args)), rng)
 
 def maybe(effect, p):
-    return lambda: resolve(effect) if random.random() < p else None
+    return lambda rng: resolve(effect, rng) if rng.random() < p else None
 
 def sequental(*args):
-    return lambda: None if (result := ",".join(filter(lambda x: x is not None, map(resolve, args)))) == "" else result
\ No newline at end of file
+    return lambda rng: None if (result := ",".join(filter(lambda x: x is not None, map(lambda x: resolve(x, rng), args)))) == "" else result
+
+#
+# Seeding
+#
+
+def sample_rng(seed, split, index):
+    # String seeds are hashed with SHA-512, so the stream is the same on every
+    # machine and does not depend on which worker renders the sample
+    return random.Random(f'{seed}/{split}/{index}')
\ No newline at end of file